@@ -0,0 +1,37 @@
+from django.conf import settings
+
+# Number of moons resolved and written together when processing moon scans.
+scan_batch_size = 500
+if hasattr(settings, 'MOON_SCAN_BATCH_SIZE'):
+    scan_batch_size = settings.MOON_SCAN_BATCH_SIZE
+
+# Maximum number of ESI requests moonstuff will have in flight at once.
+esi_max_workers = 10
+if hasattr(settings, 'MOON_ESI_MAX_WORKERS'):
+    esi_max_workers = settings.MOON_ESI_MAX_WORKERS
+
+# Number of moons per shard when splitting scans across workers. (0 processes every scan in a single task)
+scan_shard_size = 0
+if hasattr(settings, 'MOON_SCAN_SHARD_SIZE'):
+    scan_shard_size = settings.MOON_SCAN_SHARD_SIZE
+
+# Number of seconds structure info (name, owner and type) fetched from ESI is cached for.
+structure_cache_ttl = 60 * 60 * 24 * 7
+if hasattr(settings, 'MOON_STRUCTURE_CACHE_TTL'):
+    structure_cache_ttl = settings.MOON_STRUCTURE_CACHE_TTL
+
+# Number of ledger rows written per query when storing mining ledgers.
+ledger_batch_size = 1000
+if hasattr(settings, 'MOON_LEDGER_BATCH_SIZE'):
+    ledger_batch_size = settings.MOON_LEDGER_BATCH_SIZE
+
+# Number of seconds a token is skipped for after it fails. (Doubles with each further failure, up to a day)
+token_cooldown = 60 * 10
+if hasattr(settings, 'MOON_TOKEN_COOLDOWN'):
+    token_cooldown = settings.MOON_TOKEN_COOLDOWN
+
+# Whether update_active_extractions runs as a chord callback once every observer ledger has been pulled.
+# (Requires a celery result backend, otherwise it is queued with a delay)
+ledger_chord = False
+if hasattr(settings, 'MOON_LEDGER_CHORD'):
+    ledger_chord = settings.MOON_LEDGER_CHORD
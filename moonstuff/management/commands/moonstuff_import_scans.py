@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import app_settings
+from ...parser import ScanParser, ScanParseError
+from ...tasks import _chunks, _ingest_moons
+
+
+class Command(BaseCommand):
+    help = 'Imports moon scan data from one or more files, without going through celery.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='Paths to files containing moon scan data.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=app_settings.scan_batch_size,
+            help='Number of moons to write per batch. (Default: %(default)s)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        self.stdout.write("Moonstuff Scan Importer")
+        self.stdout.write("=======================")
+
+        total_moons = 0
+        total_start = time.monotonic()
+        for path in options['files']:
+            counts = {'new': 0, 'changed': 0, 'skipped': 0}
+            seen = set()
+            start = time.monotonic()
+            try:
+                # The file is read lazily, only one batch of moons is held in memory at a time.
+                with open(path, encoding='utf-8-sig') as scan_file:
+                    for batch in _chunks(ScanParser(scan_file).iter_moons(), batch_size):
+                        for k, v in _ingest_moons(batch, seen).items():
+                            counts[k] += v
+                        self.stdout.write(f"  {path}: {len(seen)} moons processed...")
+            except OSError as e:
+                raise CommandError(f"Unable to read {path}: {e}")
+            except ScanParseError as e:
+                raise CommandError(f"Unable to parse {path}: {e}")
+
+            elapsed = time.monotonic() - start
+            total_moons += len(seen)
+            self.stdout.write(self.style.SUCCESS(
+                f"{path}: {len(seen)} moons in {elapsed:.2f}s ({len(seen) / max(elapsed, 0.001):.1f} moons/s) "
+                f"- {counts['new']} new, {counts['changed']} changed, {counts['skipped']} skipped."
+            ))
+
+        elapsed = time.monotonic() - total_start
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {total_moons} moons from {len(options['files'])} file(s) in {elapsed:.2f}s "
+            f"({total_moons / max(elapsed, 0.001):.1f} moons/s)."
+        ))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from ...tasks import process_notifications
+
+
+class Command(BaseCommand):
+    help = 'Processes stored moon mining notifications again, without fetching them from ESI.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            help='Replay every notification from this ISO 8601 datetime on, even if it was processed already. '
+                 '(Default: only notifications that have not been processed)'
+        )
+
+    def handle(self, *args, **options):
+        since = options['since']
+        if since is not None and parse_datetime(since) is None:
+            raise CommandError("--since must be an ISO 8601 datetime, e.g. 2021-06-01T00:00:00Z.")
+
+        self.stdout.write("Moonstuff Notification Replay")
+        self.stdout.write("=============================")
+
+        counts = process_notifications(since)
+        self.stdout.write(self.style.SUCCESS(
+            f"Updated {counts['updated']} extractions, cancelled {counts['cancelled']} and replaced the resources "
+            f"of {counts['moons']} moons."
+        ))
+        if counts['failed']:
+            self.stdout.write(self.style.WARNING(
+                f"{counts['failed']} notifications could not be applied, see their error in the database."
+            ))
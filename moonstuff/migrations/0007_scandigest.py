@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eveuniverse', '0004_effect_longer_name'),
+        ('moonstuff', '0006_auto_20210617_0247'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanDigest',
+            fields=[
+                ('moon', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='scan_digest', serialize=False, to='eveuniverse.evemoon')),
+                ('digest', models.CharField(max_length=64)),
+                ('last_scanned', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moonstuff', '0007_scandigest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerWatermark',
+            fields=[
+                ('observer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='watermark', serialize=False, to='moonstuff.refinery')),
+                ('last_updated', models.DateField(null=True)),
+                ('day_checksums', models.JSONField(default=dict)),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import F, Sum
+
+
+def backfill_daily_volumes(apps, schema_editor):
+    LedgerEntry = apps.get_model('moonstuff', 'LedgerEntry')
+    LedgerDailyVolume = apps.get_model('moonstuff', 'LedgerDailyVolume')
+
+    rows = LedgerEntry.objects.values('observer_id', 'last_updated', 'evetype_id')\
+        .annotate(total_quantity=Sum('quantity'), total_volume=Sum(F('quantity') * F('evetype__volume')))\
+        .order_by()
+    LedgerDailyVolume.objects.bulk_create(
+        (
+            LedgerDailyVolume(
+                observer_id=row['observer_id'],
+                day=row['last_updated'],
+                evetype_id=row['evetype_id'],
+                quantity=row['total_quantity'],
+                volume=row['total_volume'] or 0,
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eveuniverse', '0004_effect_longer_name'),
+        ('moonstuff', '0008_ledgerwatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerDailyVolume',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('quantity', models.BigIntegerField()),
+                ('volume', models.FloatField()),
+                ('evetype', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_volumes', to='eveuniverse.evetype')),
+                ('observer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_volumes', to='moonstuff.refinery')),
+            ],
+            options={
+                'default_permissions': (),
+                'unique_together': {('observer', 'day', 'evetype')},
+            },
+        ),
+        migrations.RunPython(backfill_daily_volumes, migrations.RunPython.noop),
+    ]
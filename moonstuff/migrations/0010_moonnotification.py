@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moonstuff', '0009_ledgerdailyvolume'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MoonNotification',
+            fields=[
+                ('notification_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('type', models.CharField(max_length=64)),
+                ('timestamp', models.DateTimeField()),
+                ('text', models.TextField()),
+                ('data', models.JSONField(null=True)),
+                ('processed', models.DateTimeField(db_index=True, null=True)),
+                ('character', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='moonstuff.trackingcharacter')),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:46
+
+import hashlib
+
+import pytz
+from django.db import migrations, models
+
+
+def fill_fingerprints(apps, schema_editor):
+    MoonNotification = apps.get_model('moonstuff', 'MoonNotification')
+
+    seen = set()
+    to_update = list()
+    for noti in MoonNotification.objects.order_by('notification_id').iterator():
+        structure_id = (noti.data or dict()).get('structureID')
+        timestamp = noti.timestamp.astimezone(pytz.utc).strftime('%Y-%m-%dT%H:%M:%S')
+        fingerprint = hashlib.sha256(f'{noti.type}:{structure_id}:{timestamp}'.encode()).hexdigest()
+        # Copies received by other characters are left without a fingerprint.
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            noti.fingerprint = fingerprint
+            to_update.append(noti)
+    MoonNotification.objects.bulk_update(to_update, ['fingerprint'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moonstuff', '0010_moonnotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='moonnotification',
+            name='fingerprint',
+            field=models.CharField(max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+    ]
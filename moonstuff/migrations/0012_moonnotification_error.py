@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moonstuff', '0011_moonnotification_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='moonnotification',
+            name='error',
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -39,6 +39,18 @@ class Resource(models.Model):
         default_permissions = ('add',)
 
 
+class ScanDigest(models.Model):
+    moon = models.OneToOneField(EveMoon, on_delete=models.CASCADE, primary_key=True, related_name='scan_digest')
+    digest = models.CharField(max_length=64)  # Hash of the normalized resources from the last processed scan.
+    last_scanned = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.moon_id}: {self.digest}'
+
+    class Meta:
+        default_permissions = (())
+
+
 class Refinery(models.Model):
     structure_id = models.BigIntegerField(primary_key=True)
     evetype = models.ForeignKey(EveType, on_delete=models.CASCADE)
@@ -68,6 +80,28 @@ class TrackingCharacter(models.Model):
         default_permissions = ('add',)
 
 
+class MoonNotification(models.Model):
+    """
+    Raw moon mining notification, as received from ESI.
+    """
+    notification_id = models.BigIntegerField(primary_key=True)
+    character = models.ForeignKey(TrackingCharacter, on_delete=models.CASCADE, related_name='notifications')
+    type = models.CharField(max_length=64)
+    timestamp = models.DateTimeField()
+    text = models.TextField()
+    data = models.JSONField(null=True)  # The parsed text, None if it could not be parsed.
+    # Hash of (type, structureID, timestamp). Every character in a corporation receives the same notifications.
+    fingerprint = models.CharField(max_length=64, null=True, unique=True)
+    processed = models.DateTimeField(null=True, db_index=True)
+    error = models.TextField(null=True)  # Why the notification could not be applied, if it failed.
+
+    def __str__(self):
+        return f'{self.notification_id}: {self.type}'
+
+    class Meta:
+        default_permissions = (())
+
+
 class Extraction(models.Model):
     start_time = models.DateTimeField()
     arrival_time = models.DateTimeField()
@@ -107,3 +141,33 @@ class LedgerEntry(models.Model):
         default_permissions = (())
         # For each observer we only want one record per day per character per ore type.
         unique_together = (('observer', 'last_updated', 'character_id', 'evetype'),)
+
+
+class LedgerDailyVolume(models.Model):
+    """
+    Rollup of the mining ledger, with the total mined per observer per day per ore type.
+    """
+    observer = models.ForeignKey(Refinery, on_delete=models.CASCADE, related_name='daily_volumes')
+    day = models.DateField()
+    evetype = models.ForeignKey(EveType, on_delete=models.CASCADE, related_name='daily_volumes')
+    quantity = models.BigIntegerField()
+    volume = models.FloatField()  # m3
+
+    def __str__(self):
+        return f'{self.observer_id} {self.day}: {self.volume}m3 of {self.evetype_id}'
+
+    class Meta:
+        default_permissions = (())
+        unique_together = (('observer', 'day', 'evetype'),)
+
+
+class LedgerWatermark(models.Model):
+    observer = models.OneToOneField(Refinery, on_delete=models.CASCADE, primary_key=True, related_name='watermark')
+    last_updated = models.DateField(null=True)  # The newest ledger day seen for the observer.
+    day_checksums = models.JSONField(default=dict)  # Checksum of the ledger rows for each day, keyed by ISO date.
+
+    def __str__(self):
+        return f'{self.observer_id}: {self.last_updated}'
+
+    class Meta:
+        default_permissions = (())
@@ -1,6 +1,23 @@
+import io
+import hashlib
+from decimal import Decimal
+from typing import Iterator, List, Tuple, Union, TextIO
+
+
+class ScanParseError(Exception):
+    """
+    Raised when a line of a moon scan can not be parsed.
+    """
+    def __init__(self, message: str, line_number: int = None):
+        self.line_number = line_number
+        if line_number is not None:
+            message = f'{message} (Line {line_number})'
+        super().__init__(message)
+
+
 class ScanParser:
-    def __init__(self, scan_data: str):
-        if "    " in scan_data:
+    def __init__(self, scan_data: Union[str, TextIO]):
+        if isinstance(scan_data, str) and "    " in scan_data:
             self.scan = self.__tabify(scan_data)
         else:
             self.scan = scan_data
@@ -11,34 +28,80 @@ class ScanParser:
         """
         return scan_data.replace("    ", "\t")
 
-    def parse(self) -> dict:
+    def __lines(self) -> Iterator[str]:
         """
-        Parses the scan into a dict that can then be processed.
+        Yields the lines of the scan one at a time, without building a list of all lines.
         """
-        ret = dict()
+        if isinstance(self.scan, str):
+            stream = io.StringIO(self.scan)
+        else:
+            stream = self.scan
+
+        for line in stream:
+            yield self.__tabify(line)
+
+    def iter_moons(self) -> Iterator[Tuple[int, List[dict]]]:
+        """
+        Lazily parses the scan, yielding a (moon_id, resources) tuple for each moon block as soon as it is complete.
+            Note: Works on strings as well as file-like objects, only one moon block is held in memory at a time.
+        :return:
+        """
+        moon_id = None
+        resources = list()
 
-        # Split the scan into lines, ensure any CR characters are removed.
-        scan_lines = self.scan.strip("\r").split("\n")
+        for line_number, line in enumerate(self.__lines(), start=1):
+            line = line.rstrip("\r\n")
 
-        # Remove any header lines (including moon names)
-        scan_lines = list(line for line in scan_lines if "Moon" not in line)
+            # Skip blank lines and any header lines (including moon names)
+            if not line.strip() or "Moon" in line:
+                continue
 
-        # Build dict of resources keyed to moon id
-        for line in scan_lines:
             lst = line.split("\t")[1::]  # Trim off the leading blank space
             if len(lst) < 6:
-                raise Exception("The moonscan provided appears to be malformed.")
-            moon_id = int(lst[-1])
-            ore_id = int(lst[2])
+                raise ScanParseError("The moonscan provided appears to be malformed.", line_number)
+            try:
+                line_moon_id = int(lst[-1])
+                ore_id = int(lst[2])
+            except ValueError:
+                raise ScanParseError("The moonscan provided appears to be malformed.", line_number)
             quantity = lst[1]
+
+            # A new moon id means the previous moon block is complete.
+            if moon_id is not None and line_moon_id != moon_id:
+                yield moon_id, resources
+                resources = list()
+            moon_id = line_moon_id
+            resources.append({"ore_id": ore_id, 'quantity': quantity, 'moon_id': moon_id})
+
+        if moon_id is not None:
+            yield moon_id, resources
+
+    def parse(self) -> dict:
+        """
+        Parses the scan into a dict that can then be processed.
+        """
+        ret = dict()
+
+        # Build dict of resources keyed to moon id
+        for moon_id, resources in self.iter_moons():
             if moon_id not in ret.keys():
                 ret[moon_id] = list()
-            ret[moon_id].append({"ore_id": ore_id, 'quantity': quantity, 'moon_id': moon_id})
+            ret[moon_id] += resources
 
         return ret
 
+    @staticmethod
+    def digest(resources: List[dict]) -> str:
+        """
+        Returns a hash of a moon block's resources that ignores line order and number formatting.
+        :param resources: The resources for a single moon, as yielded by iter_moons.
+        :return:
+        """
+        normalized = sorted(f"{int(res['ore_id'])}:{Decimal(res['quantity']).normalize()}" for res in resources)
+        return hashlib.sha256(";".join(normalized).encode()).hexdigest()
+
     def __str__(self) -> str:
-        return self.scan
+        return str(self.scan)
 
     def __repr__(self) -> str:
         return repr(self.scan)
@@ -1,6 +1,12 @@
+import threading
+import time
+
+from bravado.exception import HTTPError
+from django.core.cache import cache
 from esi.clients import EsiClientProvider
+from esi.errors import TokenError
 
-from . import __version__
+from . import __version__, app_settings
 
 ESI_CHARACTER_SCOPES = (
     'esi-industry.read_corporation_mining.v1',
@@ -8,4 +14,227 @@ ESI_CHARACTER_SCOPES = (
     'esi-characters.read_notifications.v1',
     )
 
+# Groups of endpoints that token health is tracked for separately.
+TOKEN_GROUP_CORPORATION = 'corporation'
+TOKEN_GROUP_STRUCTURES = 'structures'
+
+# ESI status codes that mean the token itself is no good, for each group. (Expired, revoked, or the character lost its
+# roles) A 403 from a structure endpoint only means that the character is not on that structure's ACL.
+TOKEN_ERROR_STATUS = {
+    TOKEN_GROUP_CORPORATION: (401, 403),
+    TOKEN_GROUP_STRUCTURES: (401,),
+}
+
 esi = EsiClientProvider(app_info_text="moonstuff v" + __version__)
+
+
+class EsiRequestGate:
+    """
+    Limits concurrent ESI requests based on the error limit and rate limit headers ESI sends back.
+        Concurrency grows by one for every healthy response, and is halved once the remaining error budget drops below
+        half. If the budget drops to the floor (or ESI tells us to back off) all requests wait for the window to reset.
+        Note: The error limit is shared by everything on the same IP, so the headers always reflect the real budget.
+    """
+    ERROR_LIMIT_STATUS = (420, 429)
+
+    def __init__(self, max_concurrency: int = 10, error_floor: int = 10, max_retries: int = 3):
+        self.max_concurrency = max(1, max_concurrency)
+        self.error_floor = error_floor
+        self.max_retries = max_retries
+
+        self._cond = threading.Condition()
+        self._limit = self.max_concurrency
+        self._in_flight = 0
+        self._blocked_until = 0.0
+        self._error_budget = None
+
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+
+    def _acquire(self):
+        with self._cond:
+            start = time.monotonic()
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    self._cond.wait(self._blocked_until - now)
+                elif self._in_flight >= self._limit:
+                    self._cond.wait()
+                else:
+                    break
+            self._in_flight += 1
+            self.requests += 1
+            self.throttled_seconds += time.monotonic() - start
+
+    def _release(self, headers, status_code: int = 200):
+        with self._cond:
+            self._in_flight -= 1
+            headers = headers or dict()
+            remain = headers.get('X-Esi-Error-Limit-Remain')
+            reset = headers.get('X-Esi-Error-Limit-Reset')
+            retry_after = headers.get('Retry-After')
+
+            wait = None
+            if status_code in self.ERROR_LIMIT_STATUS:
+                wait = float(retry_after or reset or 60)
+            elif remain is not None:
+                remain = int(remain)
+                if self._error_budget is None or remain > self._error_budget:
+                    # The largest value seen is the size of the budget for the current window.
+                    self._error_budget = remain
+                if remain <= self.error_floor:
+                    wait = float(reset or 60)
+                elif remain < self._error_budget / 2:
+                    self._limit = max(1, self._limit // 2)
+                elif status_code < 400:
+                    self._limit = min(self.max_concurrency, self._limit + 1)
+
+            if wait is not None:
+                self._limit = 1
+                self._blocked_until = max(self._blocked_until, time.monotonic() + wait)
+            self._cond.notify_all()
+
+    def request(self, call):
+        """
+        Runs a single ESI request under the gate.
+        :param call: callable that performs one request, returning a (result, response) tuple.
+        :return: The (result, response) tuple from call.
+        """
+        retries = 0
+        while True:
+            self._acquire()
+            try:
+                result, response = call()
+            except HTTPError as e:
+                status_code = getattr(e, 'status_code', None) or 0
+                response = getattr(e, 'response', None)
+                self._release(getattr(response, 'headers', None), status_code)
+                # 3xx responses (not modified) are not errors, and do not count against the budget.
+                if status_code >= 400:
+                    with self._cond:
+                        self.errors += 1
+                if status_code in self.ERROR_LIMIT_STATUS and retries < self.max_retries:
+                    retries += 1
+                    with self._cond:
+                        self.retries += 1
+                    continue
+                raise
+            except Exception:
+                self._release(None, 0)
+                raise
+            self._release(getattr(response, 'headers', None), getattr(response, 'status_code', 200))
+            return result, response
+
+    def results(self, operation, **kwargs):
+        """
+        Gets all pages of an ESI operation under the gate.
+        :param operation: An ESI operation from the client, that has not been run yet.
+        :return: The results of the operation.
+        """
+        operation.request_config.also_return_response = True
+        return self.request(lambda: operation.results(**kwargs))[0]
+
+    def stats(self) -> dict:
+        """
+        Returns the counters for this gate.
+        :return:
+        """
+        with self._cond:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'retries': self.retries,
+                'throttled_seconds': round(self.throttled_seconds, 2),
+                'concurrency': self._limit,
+            }
+
+
+class TokenHealth:
+    """
+    Remembers which tokens have been failing, so that every task can skip them until their cooldown ends.
+        Records are kept per group of endpoints, so that a token that fails for one group is still used for the others.
+        Records are loaded from the Django cache once, kept in memory (safe to use from worker threads) and written
+        back with save(), which should be called from the thread that created the instance.
+    """
+    MAX_COOLDOWN = 60 * 60 * 24
+
+    def __init__(self, tokens, group: str = TOKEN_GROUP_CORPORATION, cooldown: int = None):
+        self.group = group
+        self.cooldown = app_settings.token_cooldown if cooldown is None else cooldown
+        self._lock = threading.Lock()
+        self._keys = {token.pk: self._cache_key(token) for token in tokens}
+        cached = cache.get_many(self._keys.values())
+        self._records = {pk: cached[key] for pk, key in self._keys.items() if key in cached}
+        self._changed = set()
+
+    def _cache_key(self, token) -> str:
+        return f'moonstuff-token-health-{self.group}-{token.pk}'
+
+    def counts_against_token(self, error: Exception) -> bool:
+        """
+        Only errors that say something about the token count against it: auth errors from ESI for the group, and failed
+            refreshes. Network errors, server errors, error limiting and bugs are left alone.
+        :param error:
+        :return:
+        """
+        if isinstance(error, TokenError):
+            return True
+        return getattr(error, 'status_code', None) in TOKEN_ERROR_STATUS[self.group]
+
+    def usable(self, tokens) -> list:
+        """
+        Filters out the tokens that are cooling down.
+        :param tokens: list of Tokens, in the order they should be tried.
+        :return: list of Tokens, in the same order.
+        """
+        now = time.time()
+        with self._lock:
+            return [
+                token for token in tokens if self._records.get(token.pk, {'until': 0})['until'] <= now
+            ]
+
+    def failed(self, token, error: Exception = None):
+        """
+        Records a failed call, starting (or extending) the token's cooldown.
+        :param token:
+        :param error: The exception the call failed with.
+        :return:
+        """
+        if error is not None and not self.counts_against_token(error):
+            return
+        with self._lock:
+            failures = self._records.get(token.pk, {'failures': 0})['failures'] + 1
+            cooldown = min(self.cooldown * 2 ** (failures - 1), self.MAX_COOLDOWN)
+            self._records[token.pk] = {'failures': failures, 'until': time.time() + cooldown}
+            self._keys.setdefault(token.pk, self._cache_key(token))
+            self._changed.add(token.pk)
+
+    def succeeded(self, token):
+        """
+        Records a successful call, clearing any failures for the token.
+        :param token:
+        :return:
+        """
+        with self._lock:
+            if self._records.pop(token.pk, None) is not None:
+                self._changed.add(token.pk)
+
+    def save(self):
+        """
+        Writes changed records back to the cache.
+        :return:
+        """
+        with self._lock:
+            failing = {self._keys[pk]: self._records[pk] for pk in self._changed if pk in self._records}
+            recovered = [self._keys[pk] for pk in self._changed if pk not in self._records]
+            self._changed = set()
+        if failing:
+            # Failure counts outlive the cooldown, so that a token that keeps failing backs off further.
+            cache.set_many(failing, self.MAX_COOLDOWN * 2)
+        if recovered:
+            cache.delete_many(recovered)
+
+
+esi_gate = EsiRequestGate(max_concurrency=app_settings.esi_max_workers)
@@ -1,28 +1,82 @@
+import hashlib
 import requests
 import yaml
 import datetime
 import pytz
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal
+from itertools import islice
 
 from allianceauth.services.hooks import get_extension_logger
 from allianceauth.notifications import notify
-from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo
-from celery import shared_task
+from allianceauth.eveonline.models import EveCorporationInfo
+from celery import shared_task, chord, group
 from eveuniverse.tasks import update_or_create_eve_object
-from eveuniverse.models import EveUniverseEntityModel, EveMarketPrice
-from django.db.models import Q, Count, Sum, F, BigIntegerField
-from django.db.models.functions import Coalesce
-from django.db.utils import IntegrityError
+from eveuniverse.models import EveUniverseEntityModel, EveMarketPrice, EveTypeDogmaAttribute
+from django.db.models import Q, Sum, F, BooleanField, DateTimeField, Exists, ExpressionWrapper, FloatField, OuterRef, \
+    Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.db import connection, transaction
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext as gt
 from esi.models import Token
+from bravado.exception import HTTPNotModified
 
-from .providers import esi, ESI_CHARACTER_SCOPES
+from . import app_settings
+from .providers import esi, esi_gate, ESI_CHARACTER_SCOPES, TokenHealth, TOKEN_GROUP_STRUCTURES
 from .models import \
-    EveType, Resource, EveMoon, TrackingCharacter, Refinery, Extraction, LedgerEntry
+    EveType, Resource, EveMoon, TrackingCharacter, Refinery, Extraction, LedgerEntry, ScanDigest, LedgerWatermark, \
+    LedgerDailyVolume, MoonNotification
 from .parser import ScanParser
 
 logger = get_extension_logger(__name__)
 
+# How long ETags and response bodies from ESI are kept around for conditional requests.
+ETAG_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# How long update_active_extractions waits for the ledger tasks, when they are not run as a chord.
+LEDGER_FLAGS_DELAY = 60 * 5
+
+# Jackpot ores are the ore types with dogma attribute 2699 set to 5.
+JACKPOT_ATTRIBUTE_ID = 2699
+JACKPOT_ATTRIBUTE_VALUE = 5
+JACKPOT_TYPES_CACHE_KEY = 'moonstuff-jackpot-type-ids'
+JACKPOT_TYPES_CACHE_TIMEOUT = 60 * 60 * 24
+
+# The C loader is several times faster, but only exists when PyYAML was built against libyaml.
+NOTIFICATION_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def _get_token_index(scopes, corp_ids=None) -> dict:
+    """
+    Resolves the tokens with matching scopes for all tracked corporations, in a fixed number of queries.
+    :param scopes: list(String)
+    :param corp_ids: Optional iterable of corporation ids to limit the index to.
+    :return: dict of corporation_id -> list of Tokens (in tracking character order)
+    """
+    characters = TrackingCharacter.objects.select_related('character').order_by('pk')
+    if corp_ids is not None:
+        characters = characters.filter(character__corporation_id__in=set(corp_ids))
+    characters = list(characters)
+
+    # Token.get_token uses the first matching token for a character, so do the same here.
+    tokens = dict()
+    qs = Token.objects.filter(character_id__in=[c.character.character_id for c in characters])\
+        .require_scopes(scopes)\
+        .order_by('pk')
+    for token in qs:
+        tokens.setdefault(token.character_id, token)
+
+    index = dict()
+    for character in characters:
+        token = tokens.get(character.character.character_id)
+        if token:
+            index.setdefault(character.character.corporation_id, list()).append(token)
+    return index
+
 
 def _get_tokens(scopes):
     """
@@ -31,13 +85,7 @@ def _get_tokens(scopes):
     :return:
     """
     try:
-        tokens = list()
-        characters = TrackingCharacter.objects.all()
-        for character in characters:
-            token = Token.get_token(character.character.character_id, scopes)
-            if token:
-                tokens.append(token)
-        return tokens
+        return [token for tokens in _get_token_index(scopes).values() for token in tokens]
     except Exception as e:
         print(e)
         return False
@@ -51,23 +99,454 @@ def _get_corp_tokens(corp_id, scopes):
     :return:
     """
     try:
-        tokens = list()
-        characters = TrackingCharacter.objects.filter(character__corporation_id=corp_id)
-        for character in characters:
-            token = Token.get_token(character.character.character_id, scopes)
-            if token:
-                tokens.append(token)
-        return tokens
+        return _get_token_index(scopes, [corp_id]).get(corp_id, list())
     except Exception as e:
         print(e)
         return False
 
 
+def _chunks(iterable, size):
+    """
+    Yields lists of up to size items from an iterable, consuming it lazily.
+    :param iterable:
+    :param size: integer
+    :return:
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _resolve_moons(moon_ids):
+    """
+    Ensures that EveMoon objects exist for all of the provided ids.
+        Known moons are found with a single query, missing moons are fetched from ESI concurrently.
+    :param moon_ids: iterable of integers
+    :return: The set of moon ids that already existed.
+    """
+    moon_ids = set(moon_ids)
+    existing = set(EveMoon.objects.filter(id__in=moon_ids).values_list('id', flat=True))
+    missing = moon_ids - existing
+
+    if missing:
+        logger.debug(f'Fetching {len(missing)} missing moons from ESI.')
+        # eveuniverse saves each moon as it is fetched, so these writes can not be moved to this thread.
+        results = _fetch_concurrently(lambda moon_id: EveMoon.objects.get_or_create_esi(id=moon_id)[0], missing)
+        for result in results.values():
+            if isinstance(result, Exception):
+                raise result
+
+    return existing
+
+
+def _fetch_concurrently(fetch, keys) -> dict:
+    """
+    Calls fetch(key) for each of the keys on a thread pool bounded by MOON_ESI_MAX_WORKERS.
+        Note: fetch should only talk to ESI, any database writes belong on the calling thread.
+    :param fetch: callable taking a single key.
+    :param keys: iterable of hashable keys.
+    :return: dict of key -> result, or the exception raised while fetching that key.
+    """
+    def run(key):
+        try:
+            return fetch(key)
+        finally:
+            # Worker threads get their own connection, make sure it does not leak.
+            connection.close()
+
+    ret = dict()
+    keys = list(keys)
+    if not keys:
+        return ret
+
+    with ThreadPoolExecutor(max_workers=app_settings.esi_max_workers) as executor:
+        futures = {executor.submit(run, key): key for key in keys}
+        for future in as_completed(futures):
+            try:
+                ret[futures[future]] = future.result()
+            except Exception as e:
+                ret[futures[future]] = e
+    return ret
+
+
+def _call_with_tokens(tokens, call, health: TokenHealth = None):
+    """
+    Calls call(token) with each of the tokens in turn, until one of them works.
+    :param tokens: list of Token objects, in the order they should be tried.
+    :param call: callable taking a single token.
+    :param health: Optional TokenHealth, tokens that are cooling down are skipped and the outcome of each call recorded.
+    :return: tuple of the token that worked, and the result of the call.
+    :raises: The last exception encountered, if none of the tokens worked.
+    """
+    error = ValueError("No tokens to try.")
+    if health is not None:
+        tokens = health.usable(tokens)
+    for token in tokens:
+        try:
+            result = call(token)
+        except Exception as e:
+            logger.debug(f"Call failed with token for character {token.character_id}")
+            logger.debug(e)
+            if health is not None:
+                health.failed(token, e)
+            error = e
+            continue
+        if health is not None:
+            health.succeeded(token)
+        return token, result
+    raise error
+
+
+def _structure_cache_key(structure_id) -> str:
+    return f'moonstuff-structure-{structure_id}'
+
+
+def _get_cached_structures(structure_ids) -> dict:
+    """
+    Gets any cached structure info for the provided structure ids.
+    :param structure_ids: iterable of integers
+    :return: dict of structure_id -> dict of name, owner_id and type_id
+    """
+    keys = {_structure_cache_key(structure_id): structure_id for structure_id in structure_ids}
+    return {keys[key]: info for key, info in cache.get_many(keys.keys()).items()}
+
+
+def _cache_structures(structures: dict) -> dict:
+    """
+    Caches structure info from ESI for MOON_STRUCTURE_CACHE_TTL seconds.
+    :param structures: dict of structure_id -> structure info from ESI.
+    :return: dict of structure_id -> the cached info.
+    """
+    cached = {
+        structure_id: {'name': info['name'], 'owner_id': info['owner_id'], 'type_id': info['type_id']}
+        for structure_id, info in structures.items()
+    }
+    cache.set_many(
+        {_structure_cache_key(structure_id): info for structure_id, info in cached.items()},
+        timeout=app_settings.structure_cache_ttl
+    )
+    return cached
+
+
+def _get_structure_info(structure_id: int, token) -> dict:
+    """
+    Gets the name, owner_id and type_id of a structure, going to ESI only if it is not cached.
+    :param structure_id: integer
+    :param token: Token to use if the structure is not cached.
+    :return:
+    """
+    info = cache.get(_structure_cache_key(structure_id))
+    if info is None:
+        info = esi_gate.results(esi.client.Universe.get_universe_structures_structure_id(
+            structure_id=structure_id,
+            token=token.valid_access_token()
+        ))
+        info = _cache_structures({structure_id: info})[structure_id]
+    return info
+
+
+def _etag_cache_key(*ids) -> str:
+    return 'moonstuff-etag-' + '-'.join(str(i) for i in ids)
+
+
+def _results_if_modified(operation, stored=None, always_return=False):
+    """
+    Gets every page of an ESI operation, sending the stored ETag for each page so that ESI can reply 304.
+        Note: Safe to call from worker threads, the caller is responsible for loading and storing the ETags.
+    :param operation: An ESI operation from the client, that has not been run yet.
+    :param stored: dict of page -> (etag, result), as returned by the previous call for the same operation.
+    :param always_return: Return the stored results when nothing has changed, rather than None. For callers whose
+        target rows can also change without the ESI data changing.
+    :return: tuple of the results (or None if no page has changed), and the dict of page -> (etag, result) to store.
+    """
+    stored = stored or dict()
+    paged = 'page' in operation.operation.params
+    operation.request_config.also_return_response = True
+    headers = operation.future.request.headers
+
+    results = list()
+    pages = dict()
+    changed = False
+    page = 1
+    total_pages = 1
+    while page <= total_pages:
+        if paged:
+            operation.future.request.params['page'] = page
+        if page in stored:
+            headers['If-None-Match'] = stored[page][0]
+        else:
+            headers.pop('If-None-Match', None)
+
+        try:
+            result, response = esi_gate.request(lambda: operation.result(ignore_cache=True))
+            changed = True
+        except HTTPNotModified as e:
+            result, response = stored[page][1], e.response
+
+        if response.headers.get('ETag'):
+            pages[page] = (response.headers['ETag'], result)
+        if paged:
+            total_pages = int(response.headers.get('X-Pages', total_pages))
+        results += result
+        page += 1
+
+    # A page disappearing also counts as a change.
+    changed = changed or len(stored) > total_pages
+    return (results if changed or always_return else None), pages
+
+
+def _ledger_day_checksums(ledger) -> dict:
+    """
+    Calculates a checksum of the ledger rows for each day in a ledger.
+    :param ledger: list of ledger rows from ESI.
+    :return: dict of ISO date -> checksum
+    """
+    days = dict()
+    for entry in ledger:
+        days.setdefault(entry['last_updated'].isoformat(), list()).append(
+            f"{entry['character_id']}:{entry['type_id']}:{entry['quantity']}:{entry['recorded_corporation_id']}"
+        )
+    return {day: hashlib.sha256(";".join(sorted(rows)).encode()).hexdigest() for day, rows in days.items()}
+
+
+def _sync_ledger(observer, ledger) -> dict:
+    """
+    Writes only the days of an observer's ledger that are new or have changed since the observer's watermark.
+    :param observer: The Refinery the ledger belongs to.
+    :param ledger: list of ledger rows from ESI.
+    :return: dict of inserted, updated and unchanged row counts, and the number of days skipped.
+    """
+    watermark, _ = LedgerWatermark.objects.get_or_create(observer=observer)
+    checksums = _ledger_day_checksums(ledger)
+    changed = {day for day, checksum in checksums.items() if watermark.day_checksums.get(day) != checksum}
+    if not changed and checksums.keys() == watermark.day_checksums.keys():
+        return {'inserted': 0, 'updated': 0, 'unchanged': len(ledger), 'days_skipped': len(checksums)}
+
+    rows = [entry for entry in ledger if entry['last_updated'].isoformat() in changed]
+    with transaction.atomic():
+        counts = _upsert_ledger_entries(observer, rows)
+        _rollup_ledger_days(observer, {entry['last_updated'] for entry in rows})
+        # Only the days ESI still returns are kept, so the watermark does not grow without limit.
+        watermark.day_checksums = checksums
+        watermark.last_updated = max(entry['last_updated'] for entry in ledger)
+        watermark.save()
+
+    counts['unchanged'] += len(ledger) - len(rows)
+    counts['days_skipped'] = len(checksums) - len(changed)
+    return counts
+
+
+def _rollup_ledger_days(observer, days) -> int:
+    """
+    Rebuilds the daily mined volume rollup for an observer, for the given days only.
+    :param observer: The Refinery the ledger belongs to.
+    :param days: iterable of dates to rebuild.
+    :return: The number of rollup rows written.
+    """
+    days = set(days)
+    if not days:
+        return 0
+
+    rows = LedgerEntry.objects.filter(observer=observer, last_updated__in=days)\
+        .values('last_updated', 'evetype_id')\
+        .annotate(total_quantity=Sum('quantity'), total_volume=Sum(F('quantity') * F('evetype__volume')))\
+        .order_by()
+    volumes = [
+        LedgerDailyVolume(
+            observer=observer,
+            day=row['last_updated'],
+            evetype_id=row['evetype_id'],
+            quantity=row['total_quantity'],
+            volume=row['total_volume'] or 0,
+        )
+        for row in rows
+    ]
+
+    LedgerDailyVolume.objects.filter(observer=observer, day__in=days).delete()
+    LedgerDailyVolume.objects.bulk_create(volumes, batch_size=app_settings.ledger_batch_size)
+    return len(volumes)
+
+
+def _upsert_ledger_entries(observer, ledger) -> dict:
+    """
+    Writes the ledger rows for an observer with bulk queries, keyed on (last_updated, character_id, evetype).
+    :param observer: The Refinery the ledger belongs to.
+    :param ledger: list of ledger rows from ESI.
+    :return: dict of inserted, updated and unchanged row counts.
+    """
+    rows = dict()
+    for entry in ledger:
+        rows[(entry['last_updated'], entry['character_id'], entry['type_id'])] = entry
+
+    existing = {
+        (e.last_updated, e.character_id, e.evetype_id): e
+        for e in LedgerEntry.objects.filter(observer=observer, last_updated__in={key[0] for key in rows})
+    }
+
+    to_create = list()
+    to_update = list()
+    for key, entry in rows.items():
+        current = existing.get(key)
+        if current is None:
+            to_create.append(LedgerEntry(
+                observer=observer,
+                last_updated=entry['last_updated'],
+                character_id=entry['character_id'],
+                evetype_id=entry['type_id'],
+                quantity=entry['quantity'],
+                recorded_corporation_id=entry['recorded_corporation_id'],
+            ))
+        elif current.quantity != entry['quantity'] \
+                or current.recorded_corporation_id != entry['recorded_corporation_id']:
+            current.quantity = entry['quantity']
+            current.recorded_corporation_id = entry['recorded_corporation_id']
+            to_update.append(current)
+
+    with transaction.atomic():
+        LedgerEntry.objects.bulk_create(to_create, batch_size=app_settings.ledger_batch_size, ignore_conflicts=True)
+        LedgerEntry.objects.bulk_update(
+            to_update, ['quantity', 'recorded_corporation_id'], batch_size=app_settings.ledger_batch_size
+        )
+
+    return {
+        'inserted': len(to_create),
+        'updated': len(to_update),
+        'unchanged': len(rows) - len(to_create) - len(to_update),
+    }
+
+
+def _normalize_quantity(quantity) -> Decimal:
+    """
+    Converts a resource quantity to the Decimal that would be stored for it, so that it can be compared to stored rows.
+    :param quantity: string, float or Decimal
+    :return:
+    """
+    field = Resource._meta.get_field('quantity')
+    return field.to_python(quantity).quantize(Decimal(1).scaleb(-field.decimal_places))
+
+
+def _sync_resources(moon_resources: dict, partial=()) -> dict:
+    """
+    Diffs the provided resources against those stored for each moon, and only writes the rows that changed.
+    :param moon_resources: dict of moon_id -> list of resource dicts. (ore_id and quantity keys)
+    :param partial: Moon ids whose data is incomplete. Stored resources missing from the data are kept for these moons.
+    :return: dict of created, updated and deleted row counts.
+    """
+    incoming = dict()
+    for moon_id, res_l in moon_resources.items():
+        incoming[moon_id] = {int(res['ore_id']): _normalize_quantity(res['quantity']) for res in res_l}
+
+    to_update = list()
+    to_delete = list()
+    for res in Resource.objects.filter(moon_id__in=incoming.keys()).only('id', 'moon_id', 'ore_id', 'quantity'):
+        wanted = incoming[res.moon_id]
+        if res.ore_id not in wanted:
+            # Stored ore that is no longer present (or a duplicate row for an ore we have already matched)
+            if res.moon_id not in partial:
+                to_delete.append(res.id)
+            continue
+        quantity = wanted.pop(res.ore_id)
+        if res.quantity != quantity:
+            res.quantity = quantity
+            to_update.append(res)
+
+    # Anything left over in the incoming data is new.
+    to_create = [
+        Resource(moon_id=moon_id, ore_id=ore_id, quantity=quantity)
+        for moon_id, ores in incoming.items()
+        for ore_id, quantity in ores.items()
+    ]
+
+    with transaction.atomic():
+        if to_delete:
+            Resource.objects.filter(id__in=to_delete).delete()
+        if to_update:
+            Resource.objects.bulk_update(to_update, ['quantity'])
+        if to_create:
+            Resource.objects.bulk_create(to_create)
+
+    return {'created': len(to_create), 'updated': len(to_update), 'deleted': len(to_delete)}
+
+
+def _ingest_moons(moons, seen=None) -> dict:
+    """
+    Writes a batch of parsed moon blocks, skipping any moon whose scan has not changed since it was last processed.
+    :param moons: list of (moon_id, resources) tuples, as yielded by ScanParser.iter_moons.
+    :param seen: set of moon ids handled by earlier batches of the same scan. (Updated in place)
+    :return: dict of new, changed and skipped moon counts.
+    """
+    if seen is None:
+        seen = set()
+
+    moon_resources = dict()
+    for moon_id, res_l in moons:
+        moon_resources.setdefault(moon_id, list()).extend(res_l)
+
+    # Moons seen in an earlier batch had their block split up in the scan, so their digest is only partial.
+    split = moon_resources.keys() & seen
+    digests = {
+        moon_id: ScanParser.digest(res_l) for moon_id, res_l in moon_resources.items() if moon_id not in split
+    }
+    stored = dict(ScanDigest.objects.filter(moon_id__in=digests.keys()).values_list('moon_id', 'digest'))
+
+    counts = {'new': 0, 'changed': 0, 'skipped': 0}
+    for moon_id, digest in digests.items():
+        if moon_id not in stored:
+            counts['new'] += 1
+        elif stored[moon_id] != digest:
+            counts['changed'] += 1
+        else:
+            counts['skipped'] += 1
+            del moon_resources[moon_id]
+    seen.update(digests.keys())
+
+    if moon_resources:
+        _resolve_moons(moon_resources.keys())
+        _sync_resources(moon_resources, partial=split)
+
+    now = timezone.now()
+    with transaction.atomic():
+        if split:
+            ScanDigest.objects.filter(moon_id__in=split).delete()
+        ScanDigest.objects.bulk_create([
+            ScanDigest(moon_id=moon_id, digest=digest, last_scanned=now)
+            for moon_id, digest in digests.items() if moon_id not in stored
+        ])
+        ScanDigest.objects.bulk_update([
+            ScanDigest(moon_id=moon_id, digest=digest, last_scanned=now)
+            for moon_id, digest in digests.items() if moon_id in stored and stored[moon_id] != digest
+        ], ['digest', 'last_scanned'])
+
+    return counts
+
+
 def filetime_to_dt(ft):
     us = (ft - 116444736000000000) // 10
     return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=us)
 
 
+def _get_jackpot_type_ids(refresh=False) -> frozenset:
+    """
+    Gets the ids of all jackpot ore types, from the cache where possible.
+        Note: The cache is refreshed whenever types are loaded, the timeout only covers dogma loaded by child tasks.
+    :param refresh: bool, ignore any cached value and rebuild it from the database.
+    :return: frozenset of EveType ids
+    """
+    type_ids = None if refresh else cache.get(JACKPOT_TYPES_CACHE_KEY)
+    if type_ids is None:
+        type_ids = frozenset(EveTypeDogmaAttribute.objects.filter(
+            eve_dogma_attribute_id=JACKPOT_ATTRIBUTE_ID,
+            value=JACKPOT_ATTRIBUTE_VALUE,
+        ).values_list('eve_type_id', flat=True))
+        # No jackpot types means their dogma has not been loaded yet, so keep looking until it has.
+        if type_ids:
+            cache.set(JACKPOT_TYPES_CACHE_KEY, type_ids, JACKPOT_TYPES_CACHE_TIMEOUT)
+    return type_ids
+
+
 @shared_task()
 def load_types_and_mats(category_ids=None, group_ids=None, type_ids=None, force_loading_dogma=False):
     logger.debug(f'Calling eveuniverse load functions for the following args:'
@@ -117,36 +596,69 @@ def load_types_and_mats(category_ids=None, group_ids=None, type_ids=None, force_
                 enabled_sections=enabled_sections,
             )
 
+    jackpot_type_ids = _get_jackpot_type_ids(refresh=True)
+    logger.debug(f'Found {len(jackpot_type_ids)} jackpot ore types.')
+
     logger.debug('Done loading eve types! Scheduling price loading.')
     # Any time types are loaded we should ensure we have material and price data for all types
     load_prices.delay()
 
 
+def _notify_scan_result(user_id: int, counts: dict, failed=(), errors=()):
+    """
+    Sends the submitter of a moon scan a summary of what was processed.
+    :param user_id: The user that initiated the scan.
+    :param counts: dict of new, changed and skipped moon counts.
+    :param failed: Ids of moons that could not be processed.
+    :param errors: Errors encountered while processing the failed moons.
+    :return:
+    """
+    message = gt('Your moon scan has been processed.\n'
+                 'New moons: %(new)d\n'
+                 'Changed moons: %(changed)d\n'
+                 'Unchanged moons (skipped): %(skipped)d\n') % counts
+    if failed:
+        message += gt('\nThe following moons could not be processed: %(moons)s\n'
+                      'Errors Encountered: %(errors)s\n') % {
+            'moons': ', '.join(str(moon_id) for moon_id in failed),
+            'errors': '; '.join(errors)
+        }
+    notify(
+        User.objects.get(id=user_id),
+        gt('Moon Scan Processed'),
+        message=message,
+        level='warning' if failed else 'success'
+    )
+
+
 @shared_task()
 def process_scan(scan_data: str, user_id: int):
     """
     Runs the provided scan data through the parser, and creates the required resource objects.
+        Note: If MOON_SCAN_SHARD_SIZE is set, large scans are handed off to process_scan_shard tasks instead.
     :param scan_data: The raw scan data from the view.
     :param user_id: The user that initiated the scan.
     :return:
     """
     logger.debug('Processing moon scan.')
     try:
-        data = ScanParser(scan_data).parse()
-
-        resources = list()
-
-        for moon in data:
-            moon, created = EveMoon.objects.get_or_create_esi(id=int(moon))
-            if not created:
-                Resource.objects.filter(moon=moon).delete()
-
-        for res_l in data.values():
-            for res in res_l:
-                resources.append(Resource(**res))
-
-        Resource.objects.bulk_create(resources)
-        logger.debug("Successfully processed moon scan!")
+        if app_settings.scan_shard_size:
+            # Moon blocks are merged before sharding, so that no two shards ever write to the same moon.
+            moons = list(ScanParser(scan_data).parse().items())
+            if len(moons) > app_settings.scan_shard_size:
+                shards = list(_chunks(moons, app_settings.scan_shard_size))
+                logger.debug(f'Splitting moon scan of {len(moons)} moons into {len(shards)} shards.')
+                chord(process_scan_shard.s(shard) for shard in shards)(process_scan_results.s(user_id))
+                return
+
+        # Moons are written in batches as soon as they have been parsed, so large scans never sit in memory at once.
+        seen = set()
+        counts = {'new': 0, 'changed': 0, 'skipped': 0}
+        for batch in _chunks(ScanParser(scan_data).iter_moons(), app_settings.scan_batch_size):
+            for k, v in _ingest_moons(batch, seen).items():
+                counts[k] += v
+        logger.debug(f"Successfully processed moon scan! {counts}")
+        _notify_scan_result(user_id, counts)
     except Exception as e:
         logger.error(f'Failed processing moon scan! (Data sent to user_id {user_id} via notification)')
         notify(
@@ -160,6 +672,59 @@ def process_scan(scan_data: str, user_id: int):
         )
 
 
+@shared_task()
+def process_scan_shard(moons: list) -> dict:
+    """
+    Processes one shard of a moon scan in its own transaction.
+        If the shard fails as a whole, its moons are retried one at a time so that a bad moon only loses itself.
+    :param moons: list of [moon_id, resources] pairs.
+    :return: dict of new, changed and skipped counts, along with the ids of failed moons and their errors.
+    """
+    ret = {'new': 0, 'changed': 0, 'skipped': 0, 'failed': list(), 'errors': list()}
+    try:
+        with transaction.atomic():
+            ret.update(_ingest_moons(moons))
+        return ret
+    except Exception as e:
+        logger.debug(f'Moon scan shard failed, retrying moons individually. ({e})')
+
+    for moon_id, res_l in moons:
+        try:
+            with transaction.atomic():
+                for k, v in _ingest_moons([(moon_id, res_l)]).items():
+                    ret[k] += v
+        except Exception as e:
+            logger.error(f'Failed processing moon {moon_id} from moon scan shard.')
+            ret['failed'].append(moon_id)
+            ret['errors'].append(f'{moon_id}: {e}')
+    return ret
+
+
+@shared_task()
+def process_scan_results(results: list, user_id: int):
+    """
+    Combines the results of all process_scan_shard tasks for a scan, and notifies the submitter once.
+    :param results: list of dicts returned by process_scan_shard.
+    :param user_id: The user that initiated the scan.
+    :return:
+    """
+    counts = {'new': 0, 'changed': 0, 'skipped': 0}
+    failed = list()
+    errors = list()
+    for result in results:
+        for k in counts:
+            counts[k] += result[k]
+        failed += result['failed']
+        errors += result['errors']
+
+    if failed:
+        logger.error(f'Failed processing {len(failed)} moons from moon scan! '
+                     f'(Sent to user_id {user_id} via notification)')
+    else:
+        logger.debug(f"Successfully processed sharded moon scan! {counts}")
+    _notify_scan_result(user_id, counts, failed, errors)
+
+
 @shared_task()
 def load_prices():
     """
@@ -173,246 +738,592 @@ def load_prices():
 def import_extraction_data():
     """
     Imports extraction data, and schedules notification checks.
+        Note: Extractions are fetched once per corporation, with the first of its tokens that works. ESI requests
+        for all corporations are made concurrently, database writes happen on the calling thread.
     :return:
     """
     client = esi.client
-    tokens = _get_tokens(ESI_CHARACTER_SCOPES)
-    for token in tokens:
+    corp_tokens = _get_token_index(ESI_CHARACTER_SCOPES)
+    corp_ids = list(corp_tokens)
+
+    # Get corp objects (and a valid access token for each token), so that worker threads only ever have to talk to ESI.
+    corps = EveCorporationInfo.objects.in_bulk(corp_tokens.keys(), field_name='corporation_id')
+    for corp_id in corp_tokens.keys() - corps.keys():
         try:
-            # Get character and corp objects to go with token
-            char = EveCharacter.objects.get(character_id=token.character_id)
+            corps[corp_id] = EveCorporationInfo.objects.create_corporation(corp_id=corp_id)
+        except Exception as e:
+            logger.error(f'Error creating corporation {corp_id}')
+            logger.error(e)
+            del corp_tokens[corp_id]
+
+    # Tokens that failed recently are skipped until their cooldown ends.
+    health = TokenHealth([token for ts in corp_tokens.values() for token in ts])
+    access_tokens = dict()
+    for corp_id in list(corp_tokens):
+        corp_tokens[corp_id] = health.usable(corp_tokens[corp_id])
+        for token in list(corp_tokens[corp_id]):
             try:
-                corp = EveCorporationInfo.objects.get(corporation_id=char.corporation_id)
-            except EveCorporationInfo.DoesNotExist:
-                corp = EveCorporationInfo.objects.create_corporation(corp_id=char.corporation_id)
+                access_tokens[token] = token.valid_access_token()
+            except Exception as e:
+                logger.error(f'Error importing extraction data from {token.character_id}')
+                logger.error(e)
+                health.failed(token, e)
+                corp_tokens[corp_id].remove(token)
+        if not corp_tokens[corp_id]:
+            del corp_tokens[corp_id]
+
+    etag_keys = {corp_id: _etag_cache_key('extractions', corp_id) for corp_id in corp_tokens}
+    etags = cache.get_many(etag_keys.values())
+
+    def fetch_events(corp_id):
+        return _call_with_tokens(
+            corp_tokens[corp_id],
+            lambda token: _results_if_modified(
+                client.Industry.get_corporation_corporation_id_mining_extractions(
+                    corporation_id=corp_id,
+                    token=access_tokens[token]
+                ),
+                etags.get(etag_keys[corp_id])
+            ),
+            health
+        )
 
-            # Get Extraction events.
-            events = client.Industry.get_corporation_corporation_id_mining_extractions(
-                corporation_id=corp.corporation_id,
-                token=token.valid_access_token()
-            ).results()
+    # Get Extraction events for all corporations at once.
+    results = _fetch_concurrently(fetch_events, corp_tokens.keys())
+    health.save()
+    logger.info(f'Fetched extractions for {len(corp_tokens)} corporations using {len(access_tokens)} tokens. '
+                f'({len(access_tokens) - len(corp_tokens)} redundant calls avoided)')
+
+    # Corporations whose extractions have not changed since the last run can be skipped entirely.
+    pages = dict()
+    for corp_id, result in list(results.items()):
+        if not isinstance(result, Exception):
+            token, (events, pages[corp_id]) = result
+            if events is None:
+                logger.debug(f'Extractions for {corp_id} have not changed.')
+                del results[corp_id]
+            else:
+                results[corp_id] = (token, events)
 
+    # Get Structure Info for any refineries we have not seen before, using the token that worked for the owning corp.
+    structure_tokens = dict()
+    for corp_id, result in results.items():
+        if not isinstance(result, Exception):
+            token, events = result
             for event in events:
-                # Get Structure Info
-                moon, _ = EveMoon.objects.get_or_create_esi(id=event['moon_id'])
-                try:
-                    refinery = Refinery.objects.get(structure_id=event['structure_id'])
-                except Refinery.DoesNotExist:
-                    ref = client.Universe.get_universe_structures_structure_id(
-                        structure_id=event['structure_id'],
-                        token=token.valid_access_token()
-                    ).results()
-                    refinery = Refinery(
-                        structure_id=event['structure_id'],
-                        name=ref['name'],
-                        corp=corp,
-                        evetype_id=ref['type_id']
-                    )
-                    refinery.save()
+                structure_tokens.setdefault(event['structure_id'], (corp_id, token))
+    known = set(
+        Refinery.objects.filter(structure_id__in=structure_tokens.keys()).values_list('structure_id', flat=True)
+    )
+    unknown = {structure_id: v for structure_id, v in structure_tokens.items() if structure_id not in known}
+
+    def fetch_structure(structure_id):
+        return esi_gate.results(client.Universe.get_universe_structures_structure_id(
+            structure_id=structure_id,
+            token=access_tokens[unknown[structure_id][1]]
+        ))
+
+    structures = _get_cached_structures(unknown.keys())
+    fetched = dict()
+    for structure_id, ref in _fetch_concurrently(fetch_structure, unknown.keys() - structures.keys()).items():
+        if isinstance(ref, Exception):
+            logger.error(f'Error getting structure info for refinery {structure_id}')
+            logger.error(ref)
+            continue
+        fetched[structure_id] = ref
+    structures.update(_cache_structures(fetched))
+
+    new_refineries = list()
+    for structure_id, ref in structures.items():
+        new_refineries.append(Refinery(
+            structure_id=structure_id,
+            name=ref['name'],
+            corp=corps[unknown[structure_id][0]],
+            evetype_id=ref['type_id']
+        ))
+    Refinery.objects.bulk_create(new_refineries, ignore_conflicts=True)
+
+    # Load everything the events refer to up front, so the number of queries does not grow with the number of events.
+    fetched = {corp_id: result for corp_id, result in results.items() if not isinstance(result, Exception)}
+    all_events = [event for _, events in fetched.values() for event in events]
+    refineries = set(
+        Refinery.objects.filter(structure_id__in={event['structure_id'] for event in all_events})
+        .values_list('structure_id', flat=True)
+    )
+    moon_ids = {event['moon_id'] for event in all_events}
+    try:
+        _resolve_moons(moon_ids)
+    except Exception as e:
+        logger.error('Error getting moons for extraction events')
+        logger.error(e)
+    moons = set(EveMoon.objects.filter(id__in=moon_ids).values_list('id', flat=True))
+
+    for corp_id, result in results.items():
+        corp = corps[corp_id]
+        try:
+            if isinstance(result, Exception):
+                raise result
+            token, events = result
+
+            existing = set(
+                Extraction.objects.filter(
+                    moon_id__in={event['moon_id'] for event in events},
+                    start_time__in={event['extraction_start_time'] for event in events},
+                ).values_list('start_time', 'moon_id')
+            )
 
+            new_extractions = dict()
+            skipped = False
+            for event in events:
                 start_time = event['extraction_start_time']
+                key = (start_time, event['moon_id'])
+                if key in existing or key in new_extractions:
+                    continue
+                if event['structure_id'] not in refineries or event['moon_id'] not in moons:
+                    # Structure or moon info could not be fetched, the next run will try again.
+                    skipped = True
+                    continue
+
                 arrival_time = event['chunk_arrival_time']
-                decay_time = event['natural_decay_time']
 
                 # Calculate the total volume for the extraction. (40k m3 per hour)
                 total_volume = ((arrival_time - start_time) / datetime.timedelta(seconds=3600)) * 40000
 
-                try:
-                    # Create the extraction event.
-                    extraction = Extraction.objects.get_or_create(
-                        start_time=start_time,
-                        arrival_time=arrival_time,
-                        decay_time=decay_time,
-                        refinery=refinery,
-                        moon=moon,
-                        corp=corp,
-                        total_volume=total_volume,
-                    )
-                except IntegrityError:
-                    continue
-                except Exception as e:
-                    logger.error(f'Error encountered when saving extraction! Corp ID: {corp.corporation_id}'
-                                 f' Refinery ID: {refinery.structure_id} Event Start: {start_time}')
-                    logger.error(e)
-            logger.info(f'Imported extraction data from {token.character_id}')
+                new_extractions[key] = Extraction(
+                    start_time=start_time,
+                    arrival_time=arrival_time,
+                    decay_time=event['natural_decay_time'],
+                    refinery_id=event['structure_id'],
+                    moon_id=event['moon_id'],
+                    corp=corp,
+                    total_volume=total_volume,
+                )
+
+            # Conflicts on (start_time, moon) mean another run got there first, which is fine.
+            Extraction.objects.bulk_create(new_extractions.values(), ignore_conflicts=True)
+            logger.info(f'Imported {len(new_extractions)} new extractions for {corp_id} from {token.character_id}')
+
+            # Only remember the ETag once everything was written, otherwise a failed import would never be retried.
+            if not skipped:
+                cache.set(etag_keys[corp_id], pages[corp_id], ETAG_CACHE_TIMEOUT)
         except Exception as e:
-            logger.error(f'Error importing extraction data from {token.character_id}')
+            logger.error(f'Error importing extraction data for {corp_id}')
             logger.error(e)
 
-        check_notifications.delay(token.character_id)
+    # Every character in a corporation receives the same notifications, so they are checked together.
+    for corp_id in corp_ids:
+        check_corp_notifications.delay(corp_id)
 
 
-@shared_task()
-def check_notifications(character_id: int):
+def _notification_time(timestamp) -> datetime.datetime:
     """
-    Checks and processes notifications related to moon mining.
-        Note: This task does not add extraction events!
-    :param character_id: The character_id to use to get a token.
+    Gets the timestamp of a notification as an aware datetime.
+    :param timestamp: The timestamp of a notification from ESI, either a datetime or a string.
     :return:
     """
-    logger.debug(f'Checking notifications for {character_id}')
-    # Define token and client, ensuring the token is valid.
-    client = esi.client
-    token = Token.get_token(character_id, ESI_CHARACTER_SCOPES)
-    char = EveCharacter.objects.get(character_id=token.character_id)
-    char = TrackingCharacter.objects.get(character=char)
-    last_noti = char.latest_notification_id
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+    if timezone.is_naive(timestamp):
+        timestamp = pytz.utc.localize(timestamp)
+    return timestamp
 
-    # Get notifications
-    notifications = client.Character.get_characters_character_id_notifications(
-        character_id=char.character.character_id,
-        token=token.valid_access_token()
-    ).results()
-    # Set the last notification id for the character
-    notifications.reverse()  # We want the newest data last... so reverse the list
-    char.latest_notification_id = notifications[-1]['notification_id']
-    char.save()
-
-    # Filter out notifications that we dont care about
-    notifications = list(
-        filter(
-            lambda n: 'Moonmining' in n['type'] and int(n['notification_id']) > last_noti,
-            notifications
-        )
-    )
 
-    # Start processing notifications
-    for noti in notifications:
-        if 'Cancelled' not in noti['type']:
-            # First parse the text from yaml format.
-            data = yaml.safe_load(noti['text'])
-
-            # Check that the moon has resources associated with it.
-            # (If a scan was never added, it might not)
-            moon, created = EveMoon.objects.get_or_create_esi(id=data['moonID'])
-
-            # Select the relevant extraction if applicable
-            if 'Finished' in noti['type']:
-                # We have decay time
-                extractions = Extraction.objects.filter(
-                    decay_time=filetime_to_dt(data['autoTime']).replace(tzinfo=pytz.utc),
-                    cancelled=False,
-                    moon=moon
-                )
-            elif 'Fracture' in noti['type']:
-                # We only have notification time
-                # If the moon auto fractured then the decay time was at or before the notification, and the
-                # arrival time was roughly 3 hours before that. (Allowing for a 5 minute window of error on notification
-                # time)
-                extractions = Extraction.objects.filter(
-                    arrival_time__gte=noti['timestamp'] - datetime.timedelta(hours=3, minutes=5),
-                    decay_time__lte=noti['timestamp'],
-                    cancelled=False,
-                    moon=moon
-                )
-            elif 'Fired' in noti['type']:
-                # We only have notification time
-                # If the laser was manually fired than it must be after the arrival time, but
-                # before the decay time.
-                extractions = Extraction.objects.filter(
-                    arrival_time__lte=noti['timestamp'],
-                    decay_time__gte=noti['timestamp'],
-                    cancelled=False,
-                    moon=moon
-                )
-            else:
-                # We have arrival time
-                logger.debug(f"ELSE {noti['type']} ID {noti['notification_id']}")
-                extractions = Extraction.objects.filter(
-                    arrival_time=filetime_to_dt(data['readyTime']).replace(tzinfo=pytz.utc),
-                    cancelled=False,
-                    moon=moon
-                )
+def _decode_notification(text: str):
+    """
+    Decodes the YAML text of a notification.
+        Note: Decoded payloads are stored with the notification, so each notification is only decoded once.
+    :param text: The notification text from ESI.
+    :return: The decoded payload.
+    """
+    return yaml.load(text, Loader=NOTIFICATION_YAML_LOADER)
 
-            if len(extractions) == 0 or len(extractions) > 1:
-                extraction = None
-            else:
-                extraction = extractions[0]
 
-            if created:
-                # If the moon was created, then we don't know about the structure yet, so lets create it.
-                owner = client.Universe.get_universe_structures_structure_id(
-                    structure_id=data['structureID'],
-                    token=token.valid_access_token()
-                ).results()['owner_id']
-                ref = Refinery(
-                    structure_id=data['structureID'],
-                    moon_id=data['moonID'],
+def _notification_fingerprint(noti_type: str, data, timestamp: datetime.datetime) -> str:
+    """
+    Identifies a notification by its content, so that copies received by different characters can be matched.
+    :param noti_type: The type of the notification.
+    :param data: The parsed notification text, or None.
+    :param timestamp: The time of the notification.
+    :return:
+    """
+    structure_id = (data or dict()).get('structureID')
+    timestamp = timestamp.astimezone(pytz.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    return hashlib.sha256(f'{noti_type}:{structure_id}:{timestamp}'.encode()).hexdigest()
+
+
+def _store_notifications(character, notifications) -> int:
+    """
+    Stores the moon mining notifications from ESI, parsing each notification's text once.
+        Note: Notifications another character already stored a copy of are skipped.
+    :param character: The TrackingCharacter the notifications were received by.
+    :param notifications: list of notifications from ESI.
+    :return: The number of notifications stored.
+    """
+    stored = dict()
+    for noti in notifications:
+        try:
+            data = _decode_notification(noti['text'])
+        except yaml.YAMLError as e:
+            logger.warning(f'Unable to parse notification {noti["notification_id"]}: {e}')
+            data = None
+        timestamp = _notification_time(noti['timestamp'])
+        fingerprint = _notification_fingerprint(noti['type'], data, timestamp)
+        stored.setdefault(fingerprint, MoonNotification(
+            notification_id=noti['notification_id'],
+            character=character,
+            type=noti['type'],
+            timestamp=timestamp,
+            text=noti['text'],
+            data=data,
+            fingerprint=fingerprint,
+        ))
+
+    for fingerprint in MoonNotification.objects.filter(fingerprint__in=stored.keys())\
+            .values_list('fingerprint', flat=True):
+        del stored[fingerprint]
+
+    # Conflicts mean another task stored the notification (or a copy of it) first, which is fine.
+    MoonNotification.objects.bulk_create(stored.values(), ignore_conflicts=True)
+    return len(stored)
+
+
+def _match_extraction(noti_type: str, data: dict, noti_time: datetime.datetime, candidates):
+    """
+    Finds the extraction a moon mining notification refers to.
+    :param noti_type: The type of the notification.
+    :param data: The parsed notification text.
+    :param noti_time: The time of the notification.
+    :param candidates: The extractions for the notification's moon.
+    :return: The extraction, or None if there is not exactly one match.
+    """
+    if 'Finished' in noti_type:
+        # We have decay time
+        decay_time = filetime_to_dt(data['autoTime']).replace(tzinfo=pytz.utc)
+        matches = [e for e in candidates if e.decay_time == decay_time]
+    elif 'Fracture' in noti_type:
+        # We only have notification time
+        # If the moon auto fractured then the decay time was at or before the notification, and the
+        # arrival time was roughly 3 hours before that. (Allowing for a 5 minute window of error on notification
+        # time)
+        earliest = noti_time - datetime.timedelta(hours=3, minutes=5)
+        matches = [e for e in candidates if e.arrival_time >= earliest and e.decay_time <= noti_time]
+    elif 'Fired' in noti_type:
+        # We only have notification time
+        # If the laser was manually fired than it must be after the arrival time, but
+        # before the decay time.
+        matches = [e for e in candidates if e.arrival_time <= noti_time <= e.decay_time]
+    else:
+        # We have arrival time
+        arrival_time = filetime_to_dt(data['readyTime']).replace(tzinfo=pytz.utc)
+        matches = [e for e in candidates if e.arrival_time == arrival_time]
+
+    # Extractions cancelled earlier in the same batch no longer count.
+    matches = [e for e in matches if not e.cancelled]
+    return matches[0] if len(matches) == 1 else None
+
+
+def _apply_moon_notifications(notifications, tokens, health: TokenHealth = None) -> dict:
+    """
+    Applies a batch of stored moon mining notifications, and marks them as processed.
+        Note: Everything the notifications refer to is loaded up front, and all changes are written in one transaction,
+        so the number of queries does not grow with the number of notifications.
+    :param notifications: list of MoonNotifications, oldest first.
+    :param tokens: list of Tokens to try for any structures that are not known yet, may be empty.
+    :param health: Optional TokenHealth for the structure endpoints.
+    :return: dict of updated and cancelled extraction counts, and the number of moons whose resources were replaced.
+    """
+    parsed = list()
+    for noti in notifications:
+        if noti.data is None:
+            continue
+        data = dict(noti.data)
+        if 'oreVolumeByType' in data:
+            # Ore type ids are stored as JSON object keys, which are always strings.
+            data['oreVolumeByType'] = {int(k): v for k, v in data['oreVolumeByType'].items()}
+        parsed.append((noti, data, noti.timestamp))
+    events = [(noti, data, t) for noti, data, t in parsed if 'Cancelled' not in noti.type]
+    cancellations = [(noti, data, t) for noti, data, t in parsed if 'Cancelled' in noti.type]
+
+    # Make sure that every moon exists. (If a scan was never added, it might not)
+    moon_ids = {data['moonID'] for _, data, _ in events}
+    created = moon_ids - _resolve_moons(moon_ids)
+
+    # If the moon was created, then we don't know about the structure yet, so lets create it.
+    new_structures = {data['structureID']: data for _, data, _ in events if data['moonID'] in created}
+    for structure_id in Refinery.objects.filter(structure_id__in=new_structures.keys())\
+            .values_list('structure_id', flat=True):
+        del new_structures[structure_id]
+    if new_structures and not tokens:
+        logger.info(f'No token to look up {len(new_structures)} new refineries with, they will be added later.')
+    elif new_structures:
+        owners = dict()
+        for structure_id in list(new_structures):
+            try:
+                _, info = _call_with_tokens(tokens, lambda token: _get_structure_info(structure_id, token), health)
+            except Exception as e:
+                logger.info(f'Unable to look up new refinery {structure_id}, it will be added later.')
+                logger.info(e)
+                del new_structures[structure_id]
+                continue
+            owners[structure_id] = info['owner_id']
+        corps = EveCorporationInfo.objects.in_bulk(set(owners.values()), field_name='corporation_id')
+        for owner in set(owners.values()) - corps.keys():
+            corps[owner] = EveCorporationInfo.objects.create_corporation(corp_id=owner)
+        Refinery.objects.bulk_create(
+            [
+                Refinery(
+                    structure_id=structure_id,
                     evetype_id=data['structureTypeID'],
                     name=data['structureName'],
-                    corp_id=owner
+                    corp=corps[owners[structure_id]],
                 )
-                ref.save()
-            res = moon.resources.all().values_list('ore_id', flat=True)
-            missing_res = list()
+                for structure_id, data in new_structures.items()
+            ],
+            ignore_conflicts=True
+        )
 
-            # Make a list of resources missing from the moon.
-            # This is used in case the data is either incorrect or incomplete.
-            for ore in data['oreVolumeByType']:
-                if ore not in res:
-                    missing_res.append(ore)
+    # Get every extraction the notifications could refer to, and the current resources of each moon.
+    structure_ids = {data['structureID'] for _, data, _ in cancellations}
+    known_refineries = set(
+        Refinery.objects.filter(structure_id__in=structure_ids).values_list('structure_id', flat=True)
+    )
+    candidates = Q(moon_id__in=moon_ids, cancelled=False)
+    if known_refineries:
+        candidates |= Q(
+            refinery_id__in=known_refineries,
+            start_time__lt=max(t for _, _, t in cancellations),
+            arrival_time__gt=min(t for _, _, t in cancellations),
+        )
+    by_moon = dict()
+    by_refinery = dict()
+    for extraction in Extraction.objects.filter(candidates):
+        by_moon.setdefault(extraction.moon_id, list()).append(extraction)
+        by_refinery.setdefault(extraction.refinery_id, list()).append(extraction)
+    resources = dict()
+    for moon_id, ore_id in Resource.objects.filter(moon_id__in=moon_ids).values_list('moon_id', 'ore_id'):
+        resources.setdefault(moon_id, set()).add(ore_id)
+
+    # Apply the notifications in order, in memory.
+    changed = dict()
+    cancelled = set()
+    new_resources = dict()
+    for noti, data, noti_time in parsed:
+        if 'Cancelled' not in noti.type:
+            moon_id = data['moonID']
+            extraction = _match_extraction(noti.type, data, noti_time, by_moon.get(moon_id, list()))
 
             # Set the active flag if the notification is either MoonminingAutomaticFracture or MoonminingLaserFired
-            if ('AutomaticFracture' in noti['type'] or 'LaserFired' in noti['type']) and extraction is not None:
+            if ('AutomaticFracture' in noti.type or 'LaserFired' in noti.type) and extraction is not None:
                 extraction.active = True
 
             # Calculate the total volume of ore
-            total_ore = 0
-            for k, v in data['oreVolumeByType'].items():
-                total_ore += v
+            total_ore = sum(data['oreVolumeByType'].values())
             # Update the total volume of ore for the extraction
             if extraction is not None:
                 extraction.total_volume = total_ore
-                extraction.save()
+                changed[extraction.pk] = extraction
+
+            # Make a list of resources missing from the moon.
+            # This is used in case the data is either incorrect or incomplete.
+            res = resources.get(moon_id, set())
+            missing_res = [ore for ore in data['oreVolumeByType'] if ore not in res]
 
             # If there is one or more missing resources, OR if there is a resource in the database
             # that shouldn't be there. We will assume that these notifications are always authoritative.
             if len(missing_res) > len(res) or len(missing_res) == len(data['oreVolumeByType']):
-                # Calculate ore percentages, and add resource objects for the moon.
-                # Create resource objects
-                new_res = list()
-                for k, v in data['oreVolumeByType'].items():
-                    pct = v / total_ore
-                    new_res.append(
-                        Resource(moon=moon, ore_id=k, quantity=pct)
-                    )
-
-                # Delete old moon resources and create new ones.
-                moon.resources.all().delete()
-                Resource.objects.bulk_create(new_res)
+                # Calculate ore percentages, and bring the moon's resources in line with them.
+                new_resources[moon_id] = [
+                    {'ore_id': k, 'quantity': v / total_ore} for k, v in data['oreVolumeByType'].items()
+                ]
+                resources[moon_id] = set(data['oreVolumeByType'])
 
-        elif 'Cancelled' in noti['type']:
+        else:
             # Determine which extraction event was cancelled and mark it as such.
-            # First Parse the timestamp
-            noti_time = datetime.datetime.strptime(noti['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
-            noti_time = pytz.timezone("UTC").localize(noti_time, is_dst=None)
-
-            # Parse the notification data from yaml
-            data = yaml.load(noti['text'])
-
-            # Get the refinery and list of extractions
-            try:
-                refinery = Refinery.objects.get(structure_id=data['structureID'])
-            except Refinery.DoesNotExist:
+            if data['structureID'] not in known_refineries:
                 logger.info(f'Got extraction cancellation notification for refinery not in database. '
-                            f'NID {noti["notification_id"]}')
+                            f'NID {noti.notification_id}')
                 continue
 
-            exts = refinery.extractions.filter(start_time__lt=noti_time, arrival_time__gt=noti_time)\
-                .order_by('-start_time')
-
-            # Cancel the extraction(s).
-            if len(exts) == 1:
-                exts[0].cancelled = True
-                exts[0].save()
-            elif len(exts) > 1:
-                for ext in exts:
-                    if ext.cancelled is not True:
-                        ext.cancelled = True
-                        ext.save()
-            else:
+            exts = [
+                e for e in by_refinery.get(data['structureID'], list())
+                if e.start_time < noti_time < e.arrival_time
+            ]
+            if not exts:
                 logger.info(f'Got extraction cancellation notification for event not in database. '
-                            f'NID {noti["notification_id"]}')
+                            f'NID {noti.notification_id}')
+            # Cancel the extraction(s).
+            for ext in exts:
+                if ext.cancelled is not True:
+                    ext.cancelled = True
+                    changed[ext.pk] = ext
+                    cancelled.add(ext.pk)
+
+    with transaction.atomic():
+        Extraction.objects.bulk_update(changed.values(), ['active', 'total_volume', 'cancelled'])
+        if new_resources and any(_sync_resources(new_resources).values()):
+            # The last scan no longer matches what is stored, so it must not be skipped if pasted again.
+            ScanDigest.objects.filter(moon_id__in=new_resources.keys()).delete()
+        MoonNotification.objects.filter(notification_id__in=[noti.notification_id for noti in notifications])\
+            .update(processed=timezone.now(), error=None)
+
+    return {'updated': len(changed), 'cancelled': len(cancelled), 'moons': len(new_resources)}
+
+
+def _apply_notifications_isolated(notifications, tokens, health: TokenHealth = None) -> dict:
+    """
+    Applies a batch of stored notifications, falling back to one notification at a time if the batch fails.
+        Notifications that fail on their own are marked as processed with their error, so that a single bad
+        notification can not hold up every later run.
+    :param notifications: list of MoonNotifications, oldest first.
+    :param tokens: list of Tokens to try for any structures that are not known yet, may be empty.
+    :param health: Optional TokenHealth for the structure endpoints.
+    :return: dict of summed counts from _apply_moon_notifications, and the number of failed notifications.
+    """
+    totals = {'updated': 0, 'cancelled': 0, 'moons': 0, 'failed': 0}
+    try:
+        totals.update(_apply_moon_notifications(notifications, tokens, health))
+        return totals
+    except Exception as e:
+        logger.warning(f'Error applying {len(notifications)} notifications as a batch, applying them one at a time.')
+        logger.warning(e)
+
+    for noti in notifications:
+        try:
+            for k, v in _apply_moon_notifications([noti], tokens, health).items():
+                totals[k] += v
+        except Exception as e:
+            logger.error(f'Error applying notification {noti.notification_id}')
+            logger.error(e)
+            MoonNotification.objects.filter(notification_id=noti.notification_id)\
+                .update(processed=timezone.now(), error=f'{type(e).__name__}: {e}')
+            totals['failed'] += 1
+    return totals
+
+
+def _process_stored_notifications(notifications) -> dict:
+    """
+    Applies stored notifications in batches, one batch per corporation of the receiving characters, in timestamp order.
+        Note: A corporation's notifications can be received by any of its characters, so batching by character would
+        apply them out of order.
+    :param notifications: QuerySet of MoonNotifications.
+    :return: dict of summed counts from _apply_notifications_isolated.
+    """
+    by_corp = dict()
+    for noti in notifications.select_related('character__character').order_by('timestamp', 'notification_id'):
+        by_corp.setdefault(noti.character.character.corporation_id, list()).append(noti)
+
+    tokens = _get_token_index(ESI_CHARACTER_SCOPES, by_corp.keys())
+    health = TokenHealth([token for ts in tokens.values() for token in ts], TOKEN_GROUP_STRUCTURES)
+    totals = {'updated': 0, 'cancelled': 0, 'moons': 0, 'failed': 0}
+    for corp_id, batch in by_corp.items():
+        for k, v in _apply_notifications_isolated(batch, tokens.get(corp_id, list()), health).items():
+            totals[k] += v
+    health.save()
+    return totals
+
+
+def _fetch_notifications(char, token) -> int:
+    """
+    Gets a character's notifications, stores any new moon mining notifications and moves the character's latest
+        notification id forward.
+    :param char: TrackingCharacter
+    :param token: Token for the character.
+    :return: The number of notifications stored.
+    """
+    last_noti = char.latest_notification_id
+
+    # Get notifications
+    notifications = esi_gate.results(esi.client.Character.get_characters_character_id_notifications(
+        character_id=char.character.character_id,
+        token=token.valid_access_token()
+    ))
+    if not notifications:
+        return 0
+
+    # Store the notifications that we care about before moving the last notification id forward, so that nothing is
+    # lost if processing them fails.
+    notifications.reverse()  # We want the newest data last... so reverse the list
+    with transaction.atomic():
+        stored = _store_notifications(char, [
+            n for n in notifications if 'Moonmining' in n['type'] and int(n['notification_id']) > last_noti
+        ])
+        char.latest_notification_id = notifications[-1]['notification_id']
+        char.last_notification_check = timezone.now()
+        char.save()
+    return stored
+
+
+@shared_task()
+def check_notifications(character_id: int):
+    """
+    Checks and processes notifications related to moon mining.
+        Note: This task does not add extraction events!
+    :param character_id: The character_id to use to get a token.
+    :return:
+    """
+    logger.debug(f'Checking notifications for {character_id}')
+    # Define token, ensuring the token is valid.
+    token = Token.get_token(character_id, ESI_CHARACTER_SCOPES)
+    char = TrackingCharacter.objects.select_related('character').get(character__character_id=token.character_id)
+    _fetch_notifications(char, token)
+
+    # Process every stored notification that has not been processed yet, as one batch.
+    counts = _apply_notifications_isolated(
+        list(char.notifications.filter(processed__isnull=True).order_by('timestamp', 'notification_id')),
+        [token]
+    )
+    logger.debug(f'Processed notifications for {character_id}: {counts}')
+
+
+@shared_task()
+def check_corp_notifications(corporation_id: int):
+    """
+    Checks the notifications of every tracking character in a corporation, and processes each moon mining event once.
+        Note: This task does not add extraction events!
+    :param corporation_id: integer
+    :return:
+    """
+    tokens = _get_token_index(ESI_CHARACTER_SCOPES, [corporation_id]).get(corporation_id, list())
+    chars = {
+        char.character.character_id: char for char in TrackingCharacter.objects.select_related('character')
+        .filter(character__character_id__in=[token.character_id for token in tokens])
+    }
+
+    stored = 0
+    for token in tokens:
+        try:
+            stored += _fetch_notifications(chars[token.character_id], token)
+        except Exception as e:
+            logger.error(f'Error checking notifications for {token.character_id}')
+            logger.error(e)
+
+    # Process the notifications of all characters in the corporation as one batch.
+    notifications = MoonNotification.objects\
+        .filter(character__character__corporation_id=corporation_id, processed__isnull=True)\
+        .order_by('timestamp', 'notification_id')
+    health = TokenHealth(tokens, TOKEN_GROUP_STRUCTURES)
+    counts = _apply_notifications_isolated(list(notifications), tokens, health)
+    health.save()
+    logger.debug(f'Processed {stored} new notifications from {len(tokens)} characters for {corporation_id}: {counts}')
+
+
+@shared_task()
+def process_notifications(since: str = None):
+    """
+    Processes stored moon mining notifications, without going to ESI for them.
+    :param since: Optional ISO 8601 datetime. When given, every notification stored from then on is processed again,
+        whether it has been processed before or not.
+    :return:
+    """
+    notifications = MoonNotification.objects.all()
+    if since is None:
+        notifications = notifications.filter(processed__isnull=True)
+    else:
+        notifications = notifications.filter(timestamp__gte=parse_datetime(since))
+
+    counts = _process_stored_notifications(notifications)
+    logger.info(f'Processed stored notifications: {counts}')
+    return counts
 
 
 @shared_task()
@@ -425,200 +1336,294 @@ def update_refineries():
     update_observers.delay()
 
 
+def _refineries_by_corp() -> dict:
+    """
+    Gets all refineries, grouped by the corporation that owns them.
+    :return: dict of corporation_id -> list of Refineries
+    """
+    refineries = dict()
+    for ref in Refinery.objects.select_related('corp'):
+        refineries.setdefault(ref.corp.corporation_id, list()).append(ref)
+    return refineries
+
+
 @shared_task()
 def update_names():
     """
     Updates the names of refineries.
-    :return:
+        Note: Structure info is cached for MOON_STRUCTURE_CACHE_TTL seconds, so names only go to ESI once it expires.
+        Only refineries whose name changed are written.
+    :return: The number of refineries that changed.
     """
-
-    client = esi.client
-
-    corps = Refinery.objects.all().values_list('corp__corporation_id', flat=True)
+    refineries = _refineries_by_corp()
     # Build a dict of tokens to try for each corp.
-    tokens = dict()
-    for corp in corps:
-        ts = _get_corp_tokens(corp, ESI_CHARACTER_SCOPES)
-        if ts:
-            tokens[corp] = ts
-
-    for corp in tokens:
-        refs = Refinery.objects.filter(corp__corporation_id=corp)
-
-        # If we have no tokens for this corp, we cant update the names... append '[STALE]' to structure names.
-        if len(tokens[corp]) == 0:
+    tokens = _get_token_index(ESI_CHARACTER_SCOPES, refineries.keys())
+    health = TokenHealth([token for ts in tokens.values() for token in ts], TOKEN_GROUP_STRUCTURES)
+    structures = _get_cached_structures(ref.structure_id for refs in refineries.values() for ref in refs)
+
+    fetched = dict()
+    changed = list()
+    for corp, refs in refineries.items():
+        # If we have no tokens for this corp, we cant update the names... mark the structure names as STALE.
+        if not tokens.get(corp):
             logger.info(f"No valid moon tracking tokens for CorpID: {corp}! Marking structures as STALE.")
             for ref in refs:
-                ref.name += " [STALE]"
-                ref.save()
+                if ref.name is not None and not ref.name.endswith(" [STALE]"):
+                    ref.name += " [STALE]"
+                    changed.append(ref)
             continue
 
         for ref in refs:
-            for token in tokens[corp]:
+            if ref.structure_id not in structures:
                 try:
-                    esi_ref = client.Universe.get_universe_structures_structure_id(
-                        structure_id=ref.structure_id,
-                        token=token.valid_access_token()
-                    ).results()
-                    ref.name = esi_ref['name']
-                    ref.save()
-                    # Break the loop once we have successfully updated with a valid token
-                    break
+                    _, fetched[ref.structure_id] = _call_with_tokens(
+                        tokens[corp],
+                        lambda token: esi_gate.results(esi.client.Universe.get_universe_structures_structure_id(
+                            structure_id=ref.structure_id,
+                            token=token.valid_access_token()
+                        )),
+                        health
+                    )
                 except Exception as e:
-                    logger.debug(f"Unable to get structure name with token: {token}")
+                    logger.debug(f"Unable to get structure name for {ref.structure_id}")
                     logger.debug(e)
                     continue
+                structures[ref.structure_id] = fetched[ref.structure_id]
+
+            if ref.name != structures[ref.structure_id]['name']:
+                ref.name = structures[ref.structure_id]['name']
+                changed.append(ref)
+
+    _cache_structures(fetched)
+    health.save()
+    if changed:
+        with transaction.atomic():
+            Refinery.objects.bulk_update(changed, ['name'])
+    logger.info(f"Updated the names of {len(changed)} refineries. ESI stats: {esi_gate.stats()}")
+    return len(changed)
 
 
 @shared_task()
 def update_observers():
     """
     Updates the observer status of all refineries.
-    :return:
+        Note: Only refineries whose observer status changed are written.
+    :return: The number of refineries that changed.
     """
 
     client = esi.client
 
-    corps = Refinery.objects.all().values_list('corp__corporation_id', flat=True)
+    refineries = _refineries_by_corp()
     # Build a dict of tokens to try for each corp.
-    tokens = dict()
-    for corp in corps:
-        ts = _get_corp_tokens(corp, ESI_CHARACTER_SCOPES)
-        if ts:
-            tokens[corp] = ts
-
-    for corp in tokens:
-        observers = None
-        # Get corp refineries
-        refineries = Refinery.objects.filter(corp__corporation_id=corp)
-        if len(tokens[corp]) == 0:
-            # If we have no tokens for this corp, none of the refineries are valid observers
-            for ref in refineries:
-                ref.observer = False
-                ref.save()
-            continue
+    tokens = _get_token_index(ESI_CHARACTER_SCOPES, refineries.keys())
+    health = TokenHealth([token for ts in tokens.values() for token in ts])
 
-        for token in tokens[corp]:
+    changed = list()
+    etags = dict()
+    for corp, refs in refineries.items():
+        if not tokens.get(corp):
+            # If we have no tokens for this corp, none of the refineries are valid observers
+            observer_ids = set()
+        else:
+            etag_key = _etag_cache_key('observers', corp)
             try:
-                observers = client.Industry.get_corporation_corporation_id_mining_observers(
-                    corporation_id=corp,
-                    token=token.valid_access_token()
-                ).results()
-                # We can break the loop once we have a working token.
-                break
+                _, (observers, pages) = _call_with_tokens(
+                    tokens[corp],
+                    lambda token: _results_if_modified(
+                        client.Industry.get_corporation_corporation_id_mining_observers(
+                            corporation_id=corp,
+                            token=token.valid_access_token()
+                        ),
+                        cache.get(etag_key),
+                        # Refineries are added (and flagged while a corp has no tokens) without the list changing,
+                        # so they are compared even when ESI replies 304.
+                        always_return=True
+                    ),
+                    health
+                )
             except Exception as e:
-                logger.debug(f"Exception getting observer with token: {token}")
+                logger.debug(f"Exception getting observers for {corp}")
                 logger.debug(e)
                 continue
-        if observers is not None:
-            observer_ids = [observer['observer_id'] for observer in observers]
-            for ref in refineries:
-                # By default refineries are created assuming they are observers, so we only need to check
-                # if they are missing from the list.
-                if ref.structure_id not in observer_ids:
-                    ref.observer = False
-                    ref.save()
+            observer_ids = {observer['observer_id'] for observer in observers}
+            if pages is not None:
+                etags[etag_key] = pages
+
+        for ref in refs:
+            if ref.observer != (ref.structure_id in observer_ids):
+                ref.observer = ref.structure_id in observer_ids
+                changed.append(ref)
+
+    health.save()
+    if changed:
+        with transaction.atomic():
+            Refinery.objects.bulk_update(changed, ['observer'])
+    # Only remember the ETags once the changes were written, otherwise they would never be retried.
+    cache.set_many(etags, ETAG_CACHE_TIMEOUT)
+    logger.info(f"Updated the observer status of {len(changed)} refineries. ESI stats: {esi_gate.stats()}")
+    return len(changed)
 
 
 @shared_task()
 def update_ledger():
     """
     Pulls mining ledger data from observers.
+        Note: Each observer is pulled by its own update_observer_ledger task. update_active_extractions runs once all
+        of them have finished when MOON_LEDGER_CHORD is enabled, and after LEDGER_FLAGS_DELAY seconds otherwise.
+    :return:
+    """
+    corps = Refinery.objects.filter(observer=True).values_list('corp__corporation_id', flat=True)
+
+    # Only observers belonging to a corp we have tokens for can be pulled.
+    tokens = _get_token_index(ESI_CHARACTER_SCOPES, corps)
+    observers = list(
+        Refinery.objects.filter(observer=True, corp__corporation_id__in=tokens.keys())
+        .values_list('structure_id', flat=True)
+    )
+
+    if not observers:
+        update_active_extractions.delay()
+        return
+
+    logger.info(f"Pulling mining ledgers for {len(observers)} observers.")
+    tasks = [update_observer_ledger.si(observer_id) for observer_id in observers]
+    if app_settings.ledger_chord:
+        chord(tasks)(update_active_extractions.si())
+    else:
+        # Chords need a result backend, so without one the flags are updated once the ledgers have most likely landed.
+        group(tasks).delay()
+        update_active_extractions.apply_async(countdown=LEDGER_FLAGS_DELAY)
+
+
+@shared_task()
+def update_observer_ledger(observer_id: int):
+    """
+    Pulls mining ledger data for a single observer.
+        Note: Never raises, a failed observer would otherwise keep the chord callback from running for all of them.
+    :param observer_id: The structure_id of the observer.
+    :return:
+    """
+    try:
+        _update_observer_ledger(observer_id)
+    except Exception as e:
+        logger.error(f"Error updating mining ledger for observer {observer_id}")
+        logger.error(e)
+
+
+def _update_observer_ledger(observer_id: int):
+    """
+    Pulls mining ledger data for a single observer.
+    :param observer_id: The structure_id of the observer.
     :return:
     """
     client = esi.client
 
-    corps = Refinery.objects.filter(observer=True).values_list('corp__corporation_id', flat=True)
+    try:
+        observer = Refinery.objects.select_related('corp').get(structure_id=observer_id)
+    except Refinery.DoesNotExist:
+        logger.info(f"Observer {observer_id} no longer exists, skipping ledger update.")
+        return
+    corp = observer.corp.corporation_id
+    tokens = _get_token_index(ESI_CHARACTER_SCOPES, [corp]).get(corp, list())
+
+    # Reset ledger to an empty tuple in case no token works.
+    ledger = ()
+    pages = None
+    etag_key = _etag_cache_key('ledger', corp, observer.structure_id)
+    health = TokenHealth(tokens)
+    try:
+        _, (ledger, pages) = _call_with_tokens(
+            tokens,
+            lambda token: _results_if_modified(
+                client.Industry.get_corporation_corporation_id_mining_observers_observer_id(
+                    corporation_id=corp,
+                    observer_id=observer.structure_id,
+                    token=token.valid_access_token()
+                ),
+                cache.get(etag_key)
+            ),
+            health
+        )
+    except Exception as e:
+        # If no working token is found, we will just skip this observer. The next
+        # update refinery task should catch and handle this.
+        logger.debug(f"Exception getting ledger entries for observer {observer.structure_id}")
+        logger.debug(e)
+    health.save()
 
-    # Build a dict of tokens for each corp that can be tried.
-    tokens = dict()
-    for corp in corps:
-        ts = _get_corp_tokens(corp, ESI_CHARACTER_SCOPES)
-        if ts:
-            tokens[corp] = ts
-
-    for corp in tokens:
-        if len(tokens[corp]) == 0:
-            # This should never happen, but we should still make sure to handle it.
-            continue
-        # Get the observers for the current corp.
-        observers = Refinery.objects.filter(observer=True, corp__corporation_id=corp)
-
-        for observer in observers:
-            # Reset ledger to an empty tuple on each iteration of the loop.
-            ledger = ()
-            for token in tokens[corp]:
-                # Try to get the ledger with each token until one works.
-                try:
-                    ledger = client.Industry.get_corporation_corporation_id_mining_observers_observer_id(
-                        corporation_id=corp,
-                        observer_id=observer.structure_id,
-                        token=token.valid_access_token()
-                    ).results()
-                    # Once a working token has been found/used we can break the token loop.
-                    break
-                except Exception as e:
-                    # If no working token is found, we will just skip this observer. The next
-                    # update refinery task should catch and handle this.
-                    logger.debug(f"Exception getting ledger entries using token: {token}")
-                    logger.debug(e)
-                    continue
+    if ledger is None:
+        logger.debug(f"Ledger for observer {observer.structure_id} has not changed.")
+        return
+    if len(ledger) == 0:
+        return
 
-            if len(ledger) != 0:
-                entries = []
-                for entry in ledger:
-                    # Change the type_id to be evetype
-                    entry['evetype_id'] = entry.pop('type_id')
-                    try:
-                        LedgerEntry.objects.update_or_create(observer=observer, **entry)
-                    except Exception as e:
-                        logger.debug(f"Error creating entry: {entry}")
-                        logger.debug(e)
-                        continue
-    update_active_extractions.delay()
+    counts = _sync_ledger(observer, ledger)
+    if pages is not None:
+        cache.set(etag_key, pages, ETAG_CACHE_TIMEOUT)
+    logger.debug(f"Updated mining ledger for observer {observer.structure_id}: {counts} ESI stats: {esi_gate.stats()}")
 
 
 @shared_task()
 def update_active_extractions():
     """
     Updates flags for active extractions.
+        Note: The jackpot check and mined volume for every active extraction come from a single grouped query.
     :return:
     """
-    # Get active extractions
-    extractions = Extraction.objects.filter(active=True)
+    # Ledger days run from the day the chunk arrived to the day it despawns.
+    despawn = ExpressionWrapper(F('decay_time') + Value(datetime.timedelta(hours=48)), output_field=DateTimeField())
+    jackpot_type_ids = _get_jackpot_type_ids()
+    if jackpot_type_ids:
+        jackpot_found = Exists(LedgerDailyVolume.objects.filter(
+            observer=OuterRef('refinery'),
+            day__gte=OuterRef('arrival_day'),
+            day__lte=OuterRef('despawn_day'),
+            evetype_id__in=jackpot_type_ids,
+        ))
+    else:
+        # Without dogma loaded there is nothing to look for.
+        jackpot_found = Value(False, output_field=BooleanField())
+    in_window = Q(
+        refinery__daily_volumes__day__gte=F('arrival_day'),
+        refinery__daily_volumes__day__lte=F('despawn_day'),
+    )
+
+    # Both checks read the daily rollup rather than the raw ledger.
+    extractions = Extraction.objects.filter(active=True)\
+        .annotate(arrival_day=TruncDate('arrival_time'), despawn_day=TruncDate(despawn))\
+        .annotate(
+            jackpot_found=jackpot_found,
+            mined_volume=Coalesce(
+                Sum('refinery__daily_volumes__volume', filter=in_window),
+                0,
+                output_field=FloatField()
+            ),
+        )
 
-    # Loop over extractions
+    now = timezone.now()
+    changed = list()
     for extraction in extractions:
+        flags = (extraction.jackpot, extraction.active, extraction.depleted)
+
         # First check if we need to set the jackpot flag.
-        entries = LedgerEntry.objects.filter(
-            observer=extraction.refinery,
-            last_updated__lte=extraction.despawn,
-            last_updated__gte=extraction.arrival_time,
-            evetype__dogma_attributes__eve_dogma_attribute=2699,
-            evetype__dogma_attributes__value=5,
-        ).aggregate(jackpot=Count('id'))
-        if entries['jackpot'] > 0:
+        if extraction.jackpot_found:
             extraction.jackpot = True
 
         # Check if extraction is past despawn time (set not active)
-        if datetime.datetime.utcnow().replace(tzinfo=pytz.utc) > extraction.despawn:
+        if now > extraction.despawn:
             extraction.active = False
 
         # Check if chunk has arrived (set not active)
-        if datetime.datetime.utcnow().replace(tzinfo=pytz.utc) < extraction.arrival_time:
+        if now < extraction.arrival_time:
             extraction.active = False
 
         # Check if the extraction has been mined out (set not active)
-        if extraction.total_volume is not None:
-            entries = LedgerEntry.objects.filter(
-                observer=extraction.refinery,
-                last_updated__gte=extraction.arrival_time,
-                last_updated__lte=extraction.despawn,
-            )\
-                .annotate(volume=Coalesce(Sum(F('quantity') * F('evetype__volume'), 0), output_field=BigIntegerField()))\
-                .aggregate(mined_volume=Sum('volume'))
-            if entries['mined_volume'] >= extraction.total_volume:
-                extraction.depleted = True
-                extraction.active = False
-
-        extraction.save()
+        if extraction.total_volume is not None and extraction.mined_volume >= extraction.total_volume:
+            extraction.depleted = True
+            extraction.active = False
+
+        if (extraction.jackpot, extraction.active, extraction.depleted) != flags:
+            changed.append(extraction)
+
+    Extraction.objects.bulk_update(changed, ['jackpot', 'active', 'depleted'])
+    logger.debug(f"Updated flags for {len(changed)} active extractions.")
@@ -0,0 +1,84 @@
+# Texts of Moonmining notifications as returned by ESI, used to test and benchmark notification decoding.
+
+extraction_started = """autoTime: 132682488000000000
+moonID: 40217116
+moonLink: <a href="showinfo:14">Erstet IX - Moon 4</a>
+oreVolumeByType:
+  45490: 2351428.3218946
+  45493: 2778993.7312254
+  45499: 6460066.0217862
+readyTime: 132682380000000000
+solarSystemID: 30003425
+solarSystemLink: <a href="showinfo:5//30003425">Erstet</a>
+startedBy: 2112625428
+startedByLink: <a href="showinfo:1380//2112625428">The First Char</a>
+structureID: 1029209158478
+structureLink: <a href="showinfo:35835//1029209158478">Erstet IX - Moon 4 - Refinery</a>
+structureName: Erstet IX - Moon 4 - Refinery
+structureTypeID: 35835
+"""
+
+extraction_finished = """autoTime: 132682488000000000
+moonID: 40217116
+moonLink: <a href="showinfo:14">Erstet IX - Moon 4</a>
+oreVolumeByType:
+  45490: 2351428.3218946
+  45493: 2778993.7312254
+  45499: 6460066.0217862
+solarSystemID: 30003425
+solarSystemLink: <a href="showinfo:5//30003425">Erstet</a>
+structureID: 1029209158478
+structureLink: <a href="showinfo:35835//1029209158478">Erstet IX - Moon 4 - Refinery</a>
+structureName: Erstet IX - Moon 4 - Refinery
+structureTypeID: 35835
+"""
+
+laser_fired = """firedBy: 2112625428
+firedByLink: <a href="showinfo:1380//2112625428">The First Char</a>
+moonID: 40217116
+moonLink: <a href="showinfo:14">Erstet IX - Moon 4</a>
+oreVolumeByType:
+  45490: 2351428.3218946
+  45493: 2778993.7312254
+  45499: 6460066.0217862
+solarSystemID: 30003425
+solarSystemLink: <a href="showinfo:5//30003425">Erstet</a>
+structureID: 1029209158478
+structureLink: <a href="showinfo:35835//1029209158478">Erstet IX - Moon 4 - Refinery</a>
+structureName: Erstet IX - Moon 4 - Refinery
+structureTypeID: 35835
+"""
+
+automatic_fracture = """moonID: 40217116
+moonLink: <a href="showinfo:14">Erstet IX - Moon 4</a>
+oreVolumeByType:
+  45490: 2351428.3218946
+  45493: 2778993.7312254
+  45499: 6460066.0217862
+solarSystemID: 30003425
+solarSystemLink: <a href="showinfo:5//30003425">Erstet</a>
+structureID: 1029209158478
+structureLink: <a href="showinfo:35835//1029209158478">Erstet IX - Moon 4 - Refinery</a>
+structureName: Erstet IX - Moon 4 - Refinery
+structureTypeID: 35835
+"""
+
+extraction_cancelled = """cancelledBy: 2112625428
+cancelledByLink: <a href="showinfo:1380//2112625428">The First Char</a>
+moonID: 40217116
+moonLink: <a href="showinfo:14">Erstet IX - Moon 4</a>
+solarSystemID: 30003425
+solarSystemLink: <a href="showinfo:5//30003425">Erstet</a>
+structureID: 1029209158478
+structureLink: <a href="showinfo:35835//1029209158478">Erstet IX - Moon 4 - Refinery</a>
+structureName: Erstet IX - Moon 4 - Refinery
+structureTypeID: 35835
+"""
+
+corpus = {
+    'MoonminingExtractionStarted': extraction_started,
+    'MoonminingExtractionFinished': extraction_finished,
+    'MoonminingLaserFired': laser_fired,
+    'MoonminingAutomaticFracture': automatic_fracture,
+    'MoonminingExtractionCancelled': extraction_cancelled,
+}
@@ -19,4 +19,14 @@ malformed = """Moon	Moon Product	Quantity	Ore TypeID	SolarSystemID	PlanetID	Moon
 Erstet IX - Moon 4
 	Coesite	0.239822223783	45493	30003425	40217111	40217116
 	Sperrylite	0.557235956192	45499	30003425	40217116
-	Zeolites	0.202941834927	45490	30003425	40217111	40217116"""
\ No newline at end of file
+	Zeolites	0.202941834927	45490	30003425	40217111	40217116"""
+
+multiple_moons = """Moon	Moon Product	Quantity	Ore TypeID	SolarSystemID	PlanetID	MoonID
+Erstet IX - Moon 4
+	Coesite	0.239822223783	45493	30003425	40217111	40217116
+	Sperrylite	0.557235956192	45499	30003425	40217111	40217116
+	Zeolites	0.202941834927	45490	30003425	40217111	40217116
+Erstet IX - Moon 5
+	Coesite	0.5	45493	30003425	40217111	40217117
+	Zeolites	0.5	45490	30003425	40217111	40217117
+"""
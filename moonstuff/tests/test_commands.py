@@ -0,0 +1,73 @@
+import os
+import tempfile
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from eveuniverse.models import EveMoon, EvePlanet, EveSolarSystem, EveConstellation, EveType, EveGroup, EveCategory,\
+    EveRegion
+
+from ..models import Resource
+from .parser_strings import with_header, malformed
+
+
+class TestImportScansCommand(TestCase):
+    def setUp(self):
+        EveCategory.objects.create(id=1, published=True)
+        EveGroup.objects.create(id=1, published=True, eve_category_id=1)
+        for type_id in (1, 45490, 45493, 45499):
+            EveType.objects.create(id=type_id, published=True, eve_group_id=1)
+        EveRegion.objects.create(id=1)
+        EveConstellation.objects.create(id=1, eve_region_id=1)
+        EveSolarSystem.objects.create(id=1, security_status=1, eve_constellation_id=1)
+        EvePlanet.objects.create(id=1, eve_solar_system_id=1, eve_type_id=1)
+        EveMoon.objects.create(id=40217116, eve_planet_id=1)
+
+    def write_scan(self, scan: str) -> str:
+        """
+        Writes a scan to a temporary file, that is removed once the test is done.
+        :param scan:
+        :return: The path of the file.
+        """
+        fd, path = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fd, 'w', encoding='utf-8') as scan_file:
+            scan_file.write(scan)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import_scans(self):
+        """
+        Test that a scan file is imported, and that importing it again skips every moon.
+        :return:
+        """
+        path = self.write_scan(with_header)
+
+        out = StringIO()
+        call_command('moonstuff_import_scans', path, stdout=out)
+        self.assertEqual(
+            set(Resource.objects.filter(moon_id=40217116).values_list('ore_id', flat=True)), {45490, 45493, 45499}
+        )
+        self.assertIn("1 new, 0 changed, 0 skipped.", out.getvalue())
+
+        out = StringIO()
+        call_command('moonstuff_import_scans', path, stdout=out)
+        self.assertEqual(Resource.objects.filter(moon_id=40217116).count(), 3)
+        self.assertIn("0 new, 0 changed, 1 skipped.", out.getvalue())
+
+    def test_import_scans_invalid_batch_size(self):
+        """
+        Test that a batch size below 1 is rejected.
+        :return:
+        """
+        path = self.write_scan(with_header)
+        with self.assertRaisesMessage(CommandError, "--batch-size must be at least 1."):
+            call_command('moonstuff_import_scans', path, batch_size=0, stdout=StringIO())
+
+    def test_import_scans_malformed(self):
+        """
+        Test that a malformed scan is rejected with the number of the offending line.
+        :return:
+        """
+        path = self.write_scan(malformed)
+        with self.assertRaisesMessage(CommandError, "(Line 4)"):
+            call_command('moonstuff_import_scans', path, stdout=StringIO())
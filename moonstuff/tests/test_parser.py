@@ -1,7 +1,8 @@
+import io
 from unittest import mock
 from django.test import TestCase
-from ..parser import ScanParser
-from .parser_strings import with_header, without_header, with_quad_spaces, malformed
+from ..parser import ScanParser, ScanParseError
+from .parser_strings import with_header, without_header, with_quad_spaces, malformed, multiple_moons
 
 
 class TestScanParser(TestCase):
@@ -61,3 +62,44 @@ class TestScanParser(TestCase):
         """
         scan_str = ScanParser(with_quad_spaces).__str__()
         self.assertEqual(scan_str, with_header)
+
+    def test_iter_moons(self):
+        """
+        Test that iter_moons yields one moon block at a time.
+        :return:
+        """
+        moons = ScanParser(multiple_moons).iter_moons()
+        moon_id, resources = next(moons)
+        self.assertEqual(moon_id, 40217116)
+        self.assertEqual(resources, self.expected_result[40217116])
+        moon_id, resources = next(moons)
+        self.assertEqual(moon_id, 40217117)
+        self.assertEqual(len(resources), 2)
+        self.assertRaises(StopIteration, next, moons)
+
+    def test_iter_moons_from_file(self):
+        """
+        Test that iter_moons will read scan data from a file-like object.
+        :return:
+        """
+        result = dict(ScanParser(io.StringIO(with_quad_spaces)).iter_moons())
+        self.assertEqual(result, self.expected_result)
+
+    def test_iter_moons_malformed_line_number(self):
+        """
+        Test that errors raised while streaming include the offending line number.
+        :return:
+        """
+        with self.assertRaises(ScanParseError) as cm:
+            list(ScanParser(malformed).iter_moons())
+        self.assertEqual(cm.exception.line_number, 4)
+
+    def test_digest(self):
+        """
+        Test that the digest of a moon block does not depend on line order or formatting.
+        :return:
+        """
+        resources = self.expected_result[40217116]
+        reordered = [dict(r, quantity=r['quantity'] + '0') for r in reversed(resources)]
+        self.assertEqual(ScanParser.digest(resources), ScanParser.digest(reordered))
+        self.assertNotEqual(ScanParser.digest(resources), ScanParser.digest(resources[1:]))
@@ -0,0 +1,160 @@
+from unittest import mock
+from requests.exceptions import ConnectionError, ReadTimeout
+from django.test import TestCase
+from bravado.exception import HTTPError, HTTPForbidden
+from esi.errors import TokenExpiredError
+
+from ..providers import EsiRequestGate, TokenHealth, TOKEN_GROUP_CORPORATION, TOKEN_GROUP_STRUCTURES
+
+
+def response(status_code=200, **headers):
+    return mock.Mock(status_code=status_code, headers=headers, reason='', text='')
+
+
+class TestEsiRequestGate(TestCase):
+    def setUp(self):
+        self.gate = EsiRequestGate(max_concurrency=4, error_floor=10, max_retries=2)
+
+    def test_request_returns_result(self):
+        """
+        Test that the gate passes results through and counts requests.
+        :return:
+        """
+        result = self.gate.request(lambda: ('data', response(**{'X-Esi-Error-Limit-Remain': '100'})))
+        self.assertEqual(result[0], 'data')
+        self.assertEqual(self.gate.stats()['requests'], 1)
+        self.assertEqual(self.gate.stats()['concurrency'], 4)
+
+    def test_concurrency_halved_when_budget_low(self):
+        """
+        Test that concurrency is reduced once less than half of the error budget remains.
+        :return:
+        """
+        self.gate.request(lambda: ('data', response(**{'X-Esi-Error-Limit-Remain': '100'})))
+        error = HTTPForbidden(response(403, **{'X-Esi-Error-Limit-Remain': '40', 'X-Esi-Error-Limit-Reset': '30'}))
+
+        def call():
+            raise error
+
+        self.assertRaises(HTTPForbidden, self.gate.request, call)
+        self.assertEqual(self.gate.stats()['concurrency'], 2)
+        self.assertEqual(self.gate.stats()['errors'], 1)
+        self.assertEqual(self.gate.stats()['retries'], 0)
+
+    @mock.patch('moonstuff.providers.time.monotonic')
+    def test_blocks_at_error_floor(self, monotonic):
+        """
+        Test that requests are held back until the error window resets once the floor is reached.
+        :return:
+        """
+        monotonic.return_value = 1000.0
+        self.gate.request(lambda: ('data', response(**{'X-Esi-Error-Limit-Remain': '5',
+                                                        'X-Esi-Error-Limit-Reset': '30'})))
+        self.assertEqual(self.gate._blocked_until, 1030.0)
+        self.assertEqual(self.gate.stats()['concurrency'], 1)
+
+    def test_retries_when_error_limited(self):
+        """
+        Test that error limited (420) responses are retried, and counted.
+        :return:
+        """
+        calls = [
+            HTTPError(response(420, **{'Retry-After': '0'})),
+            ('data', response(**{'X-Esi-Error-Limit-Remain': '100'})),
+        ]
+        calls[0].status_code = 420
+
+        def call():
+            ret = calls.pop(0)
+            if isinstance(ret, Exception):
+                raise ret
+            return ret
+
+        self.assertEqual(self.gate.request(call)[0], 'data')
+        self.assertEqual(self.gate.stats()['retries'], 1)
+        self.assertEqual(self.gate.stats()['errors'], 1)
+
+
+class TestTokenHealth(TestCase):
+    def setUp(self):
+        self.token = mock.Mock(pk=1, character_id=1)
+        self.token2 = mock.Mock(pk=2, character_id=2)
+
+    @mock.patch('moonstuff.providers.time.time')
+    def test_failing_token_cools_down(self, now):
+        """
+        Test that a failed token is skipped until its cooldown ends, and that the cooldown doubles.
+        :return:
+        """
+        now.return_value = 1000.0
+        health = TokenHealth([self.token, self.token2], cooldown=60)
+        health.failed(self.token, HTTPForbidden(response(403)))
+        self.assertEqual(health.usable([self.token, self.token2]), [self.token2])
+
+        now.return_value = 1061.0
+        self.assertEqual(health.usable([self.token, self.token2]), [self.token, self.token2])
+        health.failed(self.token)
+        now.return_value = 1121.0
+        self.assertEqual(health.usable([self.token]), [])
+        now.return_value = 1182.0
+        self.assertEqual(health.usable([self.token]), [self.token])
+
+    def test_shared_through_cache(self):
+        """
+        Test that failures are seen by other instances once saved, and cleared again by a success.
+        :return:
+        """
+        health = TokenHealth([self.token], cooldown=60)
+        health.failed(self.token)
+        self.assertEqual(TokenHealth([self.token]).usable([self.token]), [self.token])
+        health.save()
+        self.assertEqual(TokenHealth([self.token]).usable([self.token]), [])
+
+        health = TokenHealth([self.token])
+        health.succeeded(self.token)
+        health.save()
+        self.assertEqual(TokenHealth([self.token]).usable([self.token]), [self.token])
+
+    def test_server_errors_not_counted(self):
+        """
+        Test that errors which say nothing about the token do not count against it.
+        :return:
+        """
+        health = TokenHealth([self.token], cooldown=60)
+        for status_code in (420, 502):
+            error = HTTPError(response(status_code))
+            error.status_code = status_code
+            health.failed(self.token, error)
+        self.assertEqual(health.usable([self.token]), [self.token])
+
+    def test_network_errors_not_counted(self):
+        """
+        Test that network errors and bugs do not put healthy tokens on a cooldown.
+        :return:
+        """
+        health = TokenHealth([self.token], cooldown=60)
+        for error in (ConnectionError("Connection refused"), ReadTimeout("Timed out"), KeyError('name')):
+            health.failed(self.token, error)
+        self.assertEqual(health.usable([self.token]), [self.token])
+
+    def test_token_errors_counted(self):
+        """
+        Test that failed refreshes count against the token.
+        :return:
+        """
+        health = TokenHealth([self.token], cooldown=60)
+        health.failed(self.token, TokenExpiredError())
+        self.assertEqual(health.usable([self.token]), [])
+
+    def test_groups_tracked_separately(self):
+        """
+        Test that a 403 from a structure endpoint does not count, and that failures in one group leave the others alone.
+        :return:
+        """
+        structures = TokenHealth([self.token], TOKEN_GROUP_STRUCTURES, cooldown=60)
+        structures.failed(self.token, HTTPForbidden(response(403)))
+        self.assertEqual(structures.usable([self.token]), [self.token])
+        structures.failed(self.token, TokenExpiredError())
+        structures.save()
+        self.assertEqual(TokenHealth([self.token], TOKEN_GROUP_STRUCTURES).usable([self.token]), [])
+        self.assertEqual(TokenHealth([self.token], TOKEN_GROUP_CORPORATION).usable([self.token]), [self.token])
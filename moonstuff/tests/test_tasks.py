@@ -1,16 +1,39 @@
-from unittest import mock
-from datetime import datetime
+import os
+import timeit
+import pytz
+import yaml
+from unittest import mock, skipUnless
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from allianceauth.tests.auth_utils import AuthUtils
+from bravado.exception import HTTPNotModified, HTTPForbidden
 from esi.models import Token, Scope
-from allianceauth.eveonline.models import EveCharacter
+from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo
 from eveuniverse.models import EveMoon, EvePlanet, EveSolarSystem, EveConstellation, EveType, EveGroup, EveCategory,\
-    EveRegion
+    EveRegion, EveDogmaAttribute, EveTypeDogmaAttribute
 
 
-from ..tasks import filetime_to_dt, _get_tokens, _get_corp_tokens, process_scan
-from ..models import TrackingCharacter, Resource
-from .parser_strings import with_header
+from ..tasks import filetime_to_dt, _get_tokens, _get_corp_tokens, _get_token_index, process_scan, _resolve_moons, \
+    _sync_resources, _ingest_moons, process_scan_shard, process_scan_results, import_extraction_data, \
+    _get_structure_info, _results_if_modified, update_ledger, update_observer_ledger, LEDGER_FLAGS_DELAY, \
+    _upsert_ledger_entries, _sync_ledger, update_active_extractions, _get_jackpot_type_ids, load_types_and_mats, \
+    check_notifications, _apply_moon_notifications, _store_notifications, process_notifications, \
+    check_corp_notifications, _decode_notification, update_names, update_observers
+from ..models import TrackingCharacter, Resource, ScanDigest, Refinery, Extraction, LedgerEntry, LedgerDailyVolume, \
+    MoonNotification
+from ..parser import ScanParser
+from .parser_strings import with_header, with_quad_spaces, multiple_moons
+from .notification_strings import corpus
+
+
+def esi_response(result, headers=None):
+    """
+    Builds the (result, response) tuple returned by an ESI operation's result() method.
+    """
+    return result, mock.Mock(headers=headers or dict(), status_code=200)
 
 
 class TestTasks(TestCase):
@@ -86,6 +109,26 @@ class TestTasks(TestCase):
         tokens = _get_corp_tokens(123, ["scope.v1", ])
         self.assertEqual(tokens, [self.token, ])
 
+    def test_get_token_index(self):
+        """
+        Tests that the token index maps corporations to tokens in a fixed number of queries.
+        :return:
+        """
+        for i in range(2, 5):
+            char = EveCharacter.objects.create(character_name=f"Char {i}", character_id=i, corporation_name="Corp",
+                                               corporation_id=123 + i % 2, corporation_ticker="ABC")
+            TrackingCharacter.objects.create(character=char)
+            token = Token.objects.create(access_token='access', refresh_token='refresh', user=self.user1,
+                                         character_id=i, character_name=f"Char {i}", token_type='Character',
+                                         character_owner_hash=f'hash{i}')
+            if i != 4:
+                token.scopes.add(Scope.objects.get(name="scope.v1"))
+
+        with self.assertNumQueries(3):
+            index = _get_token_index(["scope.v1", ])
+        self.assertEqual({k: [t.character_id for t in v] for k, v in index.items()}, {123: [1, 2], 124: [3]})
+        self.assertEqual(_get_token_index(["scope.v1", ], [124]).keys(), {124})
+
     def test_process_scan(self):
         """
         Tests the process_scan task.
@@ -94,3 +137,828 @@ class TestTasks(TestCase):
         process_scan(with_header, 1)
         self.assertTrue(EveMoon.objects.get(id=40217116))
         self.assertTrue(len(Resource.objects.filter(moon__id=40217116)) == 3)
+
+    def test_process_scan_rescan(self):
+        """
+        Tests that the process_scan task replaces the resources of moons that were scanned before.
+        :return:
+        """
+        Resource.objects.create(moon_id=40217116, ore_id=1, quantity=1)
+        process_scan(with_header, 1)
+        self.assertEqual(
+            set(Resource.objects.filter(moon__id=40217116).values_list('ore_id', flat=True)),
+            {45493, 45499, 45490}
+        )
+
+    @mock.patch('moonstuff.tasks.EveMoon.objects.get_or_create_esi')
+    def test_resolve_moons(self, get_or_create_esi):
+        """
+        Tests that _resolve_moons only goes to ESI for moons that are missing, and raises any errors from it.
+        :return:
+        """
+        existing = _resolve_moons([40217116, 40217117])
+        self.assertEqual(existing, {40217116})
+        get_or_create_esi.assert_called_once_with(id=40217117)
+
+        get_or_create_esi.side_effect = KeyError('name')
+        self.assertRaises(KeyError, _resolve_moons, [40217116, 40217117])
+
+    def test_sync_resources(self):
+        """
+        Tests that _sync_resources only writes the rows that changed.
+        :return:
+        """
+        unchanged = Resource.objects.create(moon_id=40217116, ore_id=45493, quantity='0.239822223783')
+        changed = Resource.objects.create(moon_id=40217116, ore_id=45499, quantity='0.1')
+        Resource.objects.create(moon_id=40217116, ore_id=1, quantity='0.5')
+
+        counts = _sync_resources({40217116: [
+            {'ore_id': 45493, 'quantity': '0.239822223783'},
+            {'ore_id': 45499, 'quantity': '0.557235956192'},
+            {'ore_id': 45490, 'quantity': '0.202941834927'},
+        ]})
+
+        self.assertEqual(counts, {'created': 1, 'updated': 1, 'deleted': 1})
+        self.assertTrue(Resource.objects.filter(id=unchanged.id).exists())
+        self.assertEqual(Resource.objects.get(id=changed.id).quantity, Decimal('0.5572359562'))
+        self.assertEqual(
+            set(Resource.objects.filter(moon_id=40217116).values_list('ore_id', flat=True)),
+            {45493, 45499, 45490}
+        )
+
+    def test_sync_resources_unchanged(self):
+        """
+        Tests that _sync_resources does not write anything when nothing changed.
+        :return:
+        """
+        process_scan(with_header, 1)
+        counts = _sync_resources(ScanParser(with_header).parse())
+        self.assertEqual(counts, {'created': 0, 'updated': 0, 'deleted': 0})
+
+    def test_ingest_moons_skips_unchanged(self):
+        """
+        Tests that moons are skipped when the same scan is submitted again.
+        :return:
+        """
+        moons = list(ScanParser(with_header).iter_moons())
+        self.assertEqual(_ingest_moons(moons), {'new': 1, 'changed': 0, 'skipped': 0})
+
+        with mock.patch('moonstuff.tasks._sync_resources') as sync:
+            moons = list(ScanParser(with_quad_spaces).iter_moons())
+            self.assertEqual(_ingest_moons(moons), {'new': 0, 'changed': 0, 'skipped': 1})
+            sync.assert_not_called()
+
+        moons[0][1][0]['quantity'] = '0.1'
+        self.assertEqual(_ingest_moons(moons), {'new': 0, 'changed': 1, 'skipped': 0})
+        self.assertEqual(Resource.objects.get(moon_id=40217116, ore_id=45493).quantity, Decimal('0.1'))
+
+    @mock.patch('moonstuff.tasks.chord')
+    @mock.patch('moonstuff.tasks.app_settings.scan_shard_size', 1)
+    def test_process_scan_sharded(self, chord):
+        """
+        Tests that process_scan hands large scans off to one shard task per shard.
+        :return:
+        """
+        process_scan(multiple_moons, 1)
+        header = list(chord.call_args[0][0])
+        self.assertEqual(len(header), 2)
+        self.assertEqual(header[0].args[0][0][0], 40217116)
+        self.assertEqual(header[1].args[0][0][0], 40217117)
+        self.assertFalse(Resource.objects.exists())
+
+    def test_process_scan_shard_isolates_bad_moon(self):
+        """
+        Tests that a failing moon does not stop the rest of its shard from being processed.
+        :return:
+        """
+        real_ingest = _ingest_moons
+
+        def ingest(moons, seen=None):
+            if any(moon_id == 1 for moon_id, _ in moons):
+                raise ValueError("Bad moon")
+            return real_ingest(moons, seen)
+
+        moons = [[1, []]] + [list(m) for m in ScanParser(with_header).iter_moons()]
+        with mock.patch('moonstuff.tasks._ingest_moons', side_effect=ingest):
+            result = process_scan_shard(moons)
+
+        self.assertEqual(result['new'], 1)
+        self.assertEqual(result['failed'], [1])
+        self.assertEqual(Resource.objects.filter(moon_id=40217116).count(), 3)
+
+    @mock.patch('moonstuff.tasks.notify')
+    def test_process_scan_results(self, notify):
+        """
+        Tests that the shard results are combined into a single notification.
+        :return:
+        """
+        process_scan_results([
+            {'new': 1, 'changed': 0, 'skipped': 2, 'failed': [], 'errors': []},
+            {'new': 0, 'changed': 1, 'skipped': 0, 'failed': [5], 'errors': ['5: Bad moon']},
+        ], self.user1.id)
+        notify.assert_called_once()
+        self.assertEqual(notify.call_args[1]['level'], 'warning')
+        self.assertIn('Changed moons: 1', notify.call_args[1]['message'])
+        self.assertIn('5: Bad moon', notify.call_args[1]['message'])
+
+    def test_ingest_moons_split_block(self):
+        """
+        Tests that a moon whose block is split across batches keeps the resources from both parts.
+        :return:
+        """
+        moons = list(ScanParser(with_header).iter_moons())
+        moon_id, resources = moons[0]
+        seen = set()
+        _ingest_moons([(moon_id, resources[:1])], seen)
+        self.assertEqual(seen, {moon_id})
+        _ingest_moons([(moon_id, resources[1:])], seen)
+        self.assertEqual(Resource.objects.filter(moon_id=moon_id).count(), 3)
+        self.assertFalse(ScanDigest.objects.filter(moon_id=moon_id).exists())
+
+    @mock.patch('moonstuff.tasks.check_corp_notifications')
+    @mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_import_extraction_data(self, esi, valid_access_token, check_corp_notifications):
+        """
+        Tests that import_extraction_data creates refineries and extractions from ESI data.
+        :return:
+        """
+        EveCorporationInfo.objects.create(corporation_id=123, corporation_name="The First Corp",
+                                          corporation_ticker="ABC", member_count=1)
+        start = datetime(2021, 1, 1, tzinfo=pytz.utc)
+        industry = esi.client.Industry
+        industry.get_corporation_corporation_id_mining_extractions.return_value.result.return_value = esi_response([{
+            'structure_id': 1000,
+            'moon_id': 40217116,
+            'extraction_start_time': start,
+            'chunk_arrival_time': start + timedelta(days=1),
+            'natural_decay_time': start + timedelta(days=1, hours=3),
+        }])
+        esi.client.Universe.get_universe_structures_structure_id.return_value.results.return_value = esi_response({
+            'name': 'Test Refinery', 'owner_id': 123, 'type_id': 1
+        })
+
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            import_extraction_data()
+
+        self.assertEqual(Refinery.objects.get(structure_id=1000).name, 'Test Refinery')
+        extraction = Extraction.objects.get(moon_id=40217116)
+        self.assertEqual(extraction.total_volume, 24 * 40000)
+        check_corp_notifications.delay.assert_called_with(123)
+
+        # Running the import again should not create any duplicates.
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            import_extraction_data()
+        self.assertEqual(Extraction.objects.count(), 1)
+
+    @mock.patch('moonstuff.tasks.check_corp_notifications')
+    @mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_import_extraction_data_once_per_corp(self, esi, valid_access_token, check_corp_notifications):
+        """
+        Tests that extractions are fetched once per corporation, falling back to the next token on failure.
+        :return:
+        """
+        EveCorporationInfo.objects.create(corporation_id=123, corporation_name="The First Corp",
+                                          corporation_ticker="ABC", member_count=1)
+        EveCharacter.objects.create(character_name="The Second Char", character_id=2, corporation_name="The First Corp",
+                                    corporation_id=123, corporation_ticker="ABC")
+        token2 = Token.objects.create(access_token='access', refresh_token='refresh', user=self.user1, character_id=2,
+                                      character_name='The Second Char', token_type='Character',
+                                      character_owner_hash='fghij')
+        operation = esi.client.Industry.get_corporation_corporation_id_mining_extractions.return_value
+
+        operation.result.side_effect = [esi_response([]), esi_response([])]
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token, token2]}):
+            import_extraction_data()
+        self.assertEqual(operation.result.call_count, 1)
+        # Notifications are checked once per corporation, not once per character.
+        check_corp_notifications.delay.assert_called_once_with(123)
+
+        operation.result.reset_mock()
+        missing_roles = HTTPForbidden(mock.Mock(status_code=403, headers=dict(), reason='', text=''))
+        operation.result.side_effect = [missing_roles, esi_response([])]
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token, token2]}):
+            import_extraction_data()
+        self.assertEqual(operation.result.call_count, 2)
+
+        # The failing token is skipped while it cools down.
+        operation.result.reset_mock()
+        operation.result.side_effect = [esi_response([])]
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token, token2]}):
+            import_extraction_data()
+        self.assertEqual(operation.result.call_count, 1)
+        self.assertEqual(valid_access_token.call_count, 5)
+
+    @mock.patch('moonstuff.tasks.esi')
+    def test_get_structure_info_cached(self, esi):
+        """
+        Tests that structure info is only fetched from ESI once.
+        :return:
+        """
+        operation = esi.client.Universe.get_universe_structures_structure_id.return_value
+        operation.results.return_value = esi_response(
+            {'name': 'Test Refinery', 'owner_id': 123, 'type_id': 1, 'solar_system_id': 1}
+        )
+        with mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access'):
+            info = _get_structure_info(1000, self.token)
+            self.assertEqual(_get_structure_info(1000, self.token), info)
+        self.assertEqual(info, {'name': 'Test Refinery', 'owner_id': 123, 'type_id': 1})
+        operation.results.assert_called_once()
+
+    def test_results_if_modified(self):
+        """
+        Tests that stored ETags are sent for each page, and that unchanged data is reported as None.
+        :return:
+        """
+        operation = mock.MagicMock()
+        operation.operation.params = {'page': None}
+        operation.future.request.headers = dict()
+        operation.future.request.params = dict()
+
+        def not_modified(etag):
+            return HTTPNotModified(response=mock.Mock(status_code=304, reason='', text='',
+                                                      headers={'ETag': etag, 'X-Pages': 2}))
+
+        operation.result.side_effect = [
+            esi_response([1], {'ETag': 'a', 'X-Pages': 2}),
+            esi_response([2], {'ETag': 'b', 'X-Pages': 2}),
+        ]
+        results, pages = _results_if_modified(operation)
+        self.assertEqual(results, [1, 2])
+        self.assertEqual(pages, {1: ('a', [1]), 2: ('b', [2])})
+
+        operation.result.side_effect = [not_modified('a'), not_modified('b')]
+        results, _ = _results_if_modified(operation, pages)
+        self.assertIsNone(results)
+        self.assertEqual(operation.future.request.headers['If-None-Match'], 'b')
+
+        operation.result.side_effect = [not_modified('a'), esi_response([3], {'ETag': 'c', 'X-Pages': 2})]
+        results, new_pages = _results_if_modified(operation, pages)
+        self.assertEqual(results, [1, 3])
+        self.assertEqual(new_pages, {1: ('a', [1]), 2: ('c', [3])})
+
+    def _create_observer(self, structure_id=1000):
+        corp, _ = EveCorporationInfo.objects.get_or_create(
+            corporation_id=123,
+            defaults={'corporation_name': "The First Corp", 'corporation_ticker': "ABC", 'member_count': 1}
+        )
+        return Refinery.objects.create(structure_id=structure_id, evetype_id=1, name="Test Refinery", corp=corp)
+
+    @mock.patch('moonstuff.tasks.app_settings.ledger_chord', True)
+    @mock.patch('moonstuff.tasks.update_active_extractions')
+    @mock.patch('moonstuff.tasks.chord')
+    def test_update_ledger_fans_out(self, chord, update_active_extractions):
+        """
+        Tests that update_ledger starts one task per observer, with update_active_extractions as the callback.
+        :return:
+        """
+        self._create_observer(1000)
+        self._create_observer(1001)
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            update_ledger()
+        header = list(chord.call_args[0][0])
+        self.assertEqual(sorted(sig.args[0] for sig in header), [1000, 1001])
+        chord.return_value.assert_called_once_with(update_active_extractions.si.return_value)
+
+    @mock.patch('moonstuff.tasks.update_active_extractions')
+    @mock.patch('moonstuff.tasks.group')
+    @mock.patch('moonstuff.tasks.chord')
+    def test_update_ledger_without_result_backend(self, chord, group, update_active_extractions):
+        """
+        Tests that update_ledger does not need a chord by default, and queues update_active_extractions with a delay.
+        :return:
+        """
+        self._create_observer(1000)
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            update_ledger()
+        chord.assert_not_called()
+        self.assertEqual([sig.args[0] for sig in group.call_args[0][0]], [1000])
+        group.return_value.delay.assert_called_once()
+        update_active_extractions.apply_async.assert_called_once_with(countdown=LEDGER_FLAGS_DELAY)
+
+    @mock.patch('moonstuff.tasks._sync_ledger', side_effect=Exception("Database error"))
+    @mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_update_observer_ledger_never_raises(self, esi, valid_access_token, sync_ledger):
+        """
+        Tests that a failing observer does not raise, so that it can not stop the chord callback.
+        :return:
+        """
+        self._create_observer(1000)
+        operation = esi.client.Industry.get_corporation_corporation_id_mining_observers_observer_id.return_value
+        operation.result.return_value = esi_response([{
+            'character_id': 1, 'last_updated': datetime(2021, 1, 1).date(), 'quantity': 100,
+            'recorded_corporation_id': 123, 'type_id': 45493,
+        }])
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            self.assertIsNone(update_observer_ledger(1000))
+        sync_ledger.assert_called_once()
+
+    @mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_update_observer_ledger(self, esi, valid_access_token):
+        """
+        Tests that update_observer_ledger stores the ledger entries of an observer.
+        :return:
+        """
+        self._create_observer(1000)
+        operation = esi.client.Industry.get_corporation_corporation_id_mining_observers_observer_id.return_value
+        operation.result.return_value = esi_response([{
+            'character_id': 1, 'last_updated': datetime(2021, 1, 1).date(), 'quantity': 100,
+            'recorded_corporation_id': 123, 'type_id': 45493,
+        }])
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            update_observer_ledger(1000)
+        self.assertEqual(LedgerEntry.objects.get(observer_id=1000).quantity, 100)
+
+    def test_upsert_ledger_entries(self):
+        """
+        Tests that ledger rows are inserted, updated or left alone as required.
+        :return:
+        """
+        observer = self._create_observer(1000)
+        day = datetime(2021, 1, 1).date()
+        ledger = [
+            {'character_id': 1, 'last_updated': day, 'quantity': 100, 'recorded_corporation_id': 123, 'type_id': 45493},
+            {'character_id': 2, 'last_updated': day, 'quantity': 50, 'recorded_corporation_id': 123, 'type_id': 45493},
+        ]
+        self.assertEqual(_upsert_ledger_entries(observer, ledger), {'inserted': 2, 'updated': 0, 'unchanged': 0})
+
+        ledger[1] = dict(ledger[1], quantity=75)
+        with self.assertNumQueries(4):
+            counts = _upsert_ledger_entries(observer, ledger)
+        self.assertEqual(counts, {'inserted': 0, 'updated': 1, 'unchanged': 1})
+        self.assertEqual(LedgerEntry.objects.get(observer=observer, character_id=2).quantity, 75)
+
+    def test_sync_ledger_skips_unchanged_days(self):
+        """
+        Tests that only new or changed ledger days are written.
+        :return:
+        """
+        observer = self._create_observer(1000)
+        day1 = datetime(2021, 1, 1).date()
+        day2 = datetime(2021, 1, 2).date()
+        ledger = [
+            {'character_id': 1, 'last_updated': day1, 'quantity': 100, 'recorded_corporation_id': 123,
+             'type_id': 45493},
+            {'character_id': 1, 'last_updated': day2, 'quantity': 50, 'recorded_corporation_id': 123,
+             'type_id': 45493},
+        ]
+        counts = _sync_ledger(observer, ledger)
+        self.assertEqual((counts['inserted'], counts['days_skipped']), (2, 0))
+        self.assertEqual(observer.watermark.last_updated, day2)
+
+        ledger[1] = dict(ledger[1], quantity=75)
+        with mock.patch('moonstuff.tasks._upsert_ledger_entries', wraps=_upsert_ledger_entries) as upsert:
+            counts = _sync_ledger(observer, ledger)
+            self.assertEqual(upsert.call_args[0][1], [ledger[1]])
+        self.assertEqual((counts['updated'], counts['days_skipped']), (1, 1))
+
+        with self.assertNumQueries(1):
+            counts = _sync_ledger(observer, ledger)
+        self.assertEqual(counts['days_skipped'], 2)
+
+    def test_sync_ledger_rolls_up_daily_volume(self):
+        """
+        Tests that the daily volume rollup follows changes to the ledger.
+        :return:
+        """
+        EveType.objects.filter(id=45493).update(volume=10)
+        observer = self._create_observer(1000)
+        day = datetime(2021, 1, 1).date()
+        ledger = [
+            {'character_id': 1, 'last_updated': day, 'quantity': 100, 'recorded_corporation_id': 123, 'type_id': 45493},
+            {'character_id': 2, 'last_updated': day, 'quantity': 50, 'recorded_corporation_id': 123, 'type_id': 45493},
+        ]
+        _sync_ledger(observer, ledger)
+        rollup = LedgerDailyVolume.objects.get(observer=observer, day=day, evetype_id=45493)
+        self.assertEqual((rollup.quantity, rollup.volume), (150, 1500))
+
+        ledger[1] = dict(ledger[1], quantity=75)
+        _sync_ledger(observer, ledger)
+        rollup = LedgerDailyVolume.objects.get(observer=observer, day=day, evetype_id=45493)
+        self.assertEqual((rollup.quantity, rollup.volume), (175, 1750))
+
+    def test_update_active_extractions(self):
+        """
+        Tests that extraction flags are set from the ledger, in a fixed number of queries.
+        :return:
+        """
+        EveType.objects.filter(id=45493).update(volume=10)
+        EveDogmaAttribute.objects.create(id=2699)
+        EveTypeDogmaAttribute.objects.create(eve_type_id=45490, eve_dogma_attribute_id=2699, value=5)
+        moon = EveMoon.objects.create(id=1, eve_planet_id=1)
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+
+        for structure_id in (1000, 1001, 1002):
+            refinery = self._create_observer(structure_id)
+            Extraction.objects.create(
+                start_time=now - timedelta(days=10, seconds=structure_id), arrival_time=now - timedelta(days=1),
+                decay_time=now + timedelta(hours=2), moon=moon, refinery=refinery, corp=refinery.corp, active=True,
+                total_volume=1000,
+            )
+        day = now.date()
+        # Mined out, before arrival (not counted), and a jackpot ore.
+        for structure_id, last_updated, quantity, type_id in (
+                (1000, day, 100, 45493), (1001, day - timedelta(days=5), 100, 45493), (1002, day, 1, 45490)):
+            _sync_ledger(Refinery.objects.get(structure_id=structure_id), [{
+                'character_id': 1, 'last_updated': last_updated, 'quantity': quantity, 'recorded_corporation_id': 123,
+                'type_id': type_id,
+            }])
+
+        _get_jackpot_type_ids(refresh=True)
+        with self.assertNumQueries(3):
+            update_active_extractions()
+
+        flags = {e.refinery_id: (e.jackpot, e.active, e.depleted) for e in Extraction.objects.all()}
+        self.assertEqual(flags, {1000: (False, False, True), 1001: (False, True, False), 1002: (True, True, False)})
+
+    @mock.patch('moonstuff.tasks.load_prices')
+    @mock.patch('moonstuff.tasks.update_or_create_eve_object')
+    def test_load_types_refreshes_jackpot_types(self, update_or_create_eve_object, load_prices):
+        """
+        Tests that the cached jackpot ore types are rebuilt whenever types are loaded.
+        :return:
+        """
+        EveDogmaAttribute.objects.create(id=2699)
+        EveTypeDogmaAttribute.objects.create(eve_type_id=45490, eve_dogma_attribute_id=2699, value=5)
+        self.assertEqual(_get_jackpot_type_ids(), frozenset({45490}))
+
+        EveTypeDogmaAttribute.objects.create(eve_type_id=45493, eve_dogma_attribute_id=2699, value=5)
+        EveTypeDogmaAttribute.objects.create(eve_type_id=45499, eve_dogma_attribute_id=2699, value=1)
+        self.assertEqual(_get_jackpot_type_ids(), frozenset({45490}))
+
+        load_types_and_mats(type_ids=[45493])
+        self.assertEqual(_get_jackpot_type_ids(), frozenset({45490, 45493}))
+        load_prices.delay.assert_called_once()
+
+    def test_jackpot_types_empty_not_cached(self):
+        """
+        Tests that no jackpot ore types are not cached, so that they are picked up as soon as their dogma is loaded.
+        :return:
+        """
+        EveDogmaAttribute.objects.create(id=2699)
+        self.assertEqual(_get_jackpot_type_ids(), frozenset())
+
+        EveTypeDogmaAttribute.objects.create(eve_type_id=45490, eve_dogma_attribute_id=2699, value=5)
+        self.assertEqual(_get_jackpot_type_ids(), frozenset({45490}))
+
+    @mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access')
+    @mock.patch('moonstuff.tasks.Token.get_token')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_check_notifications(self, esi, get_token, valid_access_token):
+        """
+        Tests that a batch of notifications is applied to extractions and moon resources.
+        :return:
+        """
+        get_token.return_value = self.token
+        now = datetime(2021, 6, 1, 12, tzinfo=pytz.utc)
+        EveMoon.objects.create(id=1, eve_planet_id=1)
+        EveMoon.objects.create(id=2, eve_planet_id=1)
+        fired = Extraction.objects.create(
+            start_time=now - timedelta(days=7), arrival_time=now - timedelta(hours=1),
+            decay_time=now + timedelta(hours=2), moon_id=1, refinery=self._create_observer(1000), corp_id=1,
+        )
+        cancelled = Extraction.objects.create(
+            start_time=now - timedelta(days=2), arrival_time=now + timedelta(days=5),
+            decay_time=now + timedelta(days=5, hours=3), moon_id=2, refinery=self._create_observer(1001), corp_id=1,
+        )
+        notifications = [
+            {'notification_id': 2, 'type': 'MoonminingExtractionCancelled', 'timestamp': now,
+             'text': 'moonID: 2\nstructureID: 1001\n'},
+            {'notification_id': 1, 'type': 'MoonminingLaserFired', 'timestamp': now,
+             'text': 'moonID: 1\noreVolumeByType:\n  45490: 500.0\n  45493: 1500.0\nstructureID: 1000\n'},
+            {'notification_id': 0, 'type': 'CorpAllBulletin', 'timestamp': now, 'text': ''},
+        ]
+        operation = esi.client.Character.get_characters_character_id_notifications.return_value
+        operation.results.return_value = esi_response(notifications)
+
+        check_notifications(1)
+
+        fired.refresh_from_db()
+        cancelled.refresh_from_db()
+        self.assertEqual((fired.active, fired.total_volume, fired.cancelled), (True, 2000, False))
+        self.assertTrue(cancelled.cancelled)
+        self.assertEqual(
+            dict(Resource.objects.filter(moon_id=1).values_list('ore_id', 'quantity')),
+            {45490: Decimal('0.25'), 45493: Decimal('0.75')}
+        )
+        self.tracking1.refresh_from_db()
+        self.assertEqual(self.tracking1.latest_notification_id, 2)
+        self.assertEqual(MoonNotification.objects.filter(processed__isnull=False).count(), 2)
+
+    @mock.patch('moonstuff.tasks.Token.get_token')
+    @mock.patch('moonstuff.tasks._apply_moon_notifications')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_check_notifications_stores_before_processing(self, esi, apply_moon_notifications, get_token):
+        """
+        Tests that notifications are kept when processing fails, and can be replayed later from the store.
+        :return:
+        """
+        get_token.return_value = self.token
+        now = datetime(2021, 6, 1, 12, tzinfo=pytz.utc)
+        operation = esi.client.Character.get_characters_character_id_notifications.return_value
+        operation.results.return_value = esi_response([
+            {'notification_id': 1, 'type': 'MoonminingExtractionCancelled', 'timestamp': now,
+             'text': 'moonID: 2\nstructureID: 1001\n'},
+        ])
+        apply_moon_notifications.side_effect = Exception("Bad deploy")
+
+        with mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access'):
+            check_notifications(1)
+        self.tracking1.refresh_from_db()
+        self.assertEqual(self.tracking1.latest_notification_id, 1)
+        noti = MoonNotification.objects.get(notification_id=1)
+        self.assertEqual((noti.data, noti.error), ({'moonID': 2, 'structureID': 1001}, 'Exception: Bad deploy'))
+
+        apply_moon_notifications.side_effect = None
+        apply_moon_notifications.return_value = {'updated': 0, 'cancelled': 0, 'moons': 0}
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            process_notifications('2021-06-01T00:00:00Z')
+        self.assertEqual(apply_moon_notifications.call_args[0][0], [noti])
+        self.assertEqual(apply_moon_notifications.call_args[0][1], [self.token])
+        esi.client.Character.get_characters_character_id_notifications.assert_called_once()
+
+    def test_apply_moon_notifications_batched(self):
+        """
+        Tests that the number of queries does not grow with the number of notifications.
+        :return:
+        """
+        now = datetime(2021, 6, 1, 12, tzinfo=pytz.utc)
+        for moon_id in range(1, 11):
+            EveMoon.objects.create(id=moon_id, eve_planet_id=1)
+            Extraction.objects.create(
+                start_time=now - timedelta(days=7), arrival_time=now - timedelta(hours=1),
+                decay_time=now + timedelta(hours=2), moon_id=moon_id, refinery=self._create_observer(1000 + moon_id),
+                corp_id=1,
+            )
+        notifications = [
+            {'notification_id': moon_id, 'type': 'MoonminingLaserFired', 'timestamp': now,
+             'text': f'moonID: {moon_id}\noreVolumeByType:\n  45490: 500.0\nstructureID: {1000 + moon_id}\n'}
+            for moon_id in range(1, 11)
+        ]
+
+        _store_notifications(self.tracking1, notifications)
+        notifications = list(MoonNotification.objects.order_by('notification_id'))
+
+        with CaptureQueriesContext(connection) as single:
+            _apply_moon_notifications(notifications[:1], self.token)
+        with CaptureQueriesContext(connection) as batch:
+            counts = _apply_moon_notifications(notifications[1:], self.token)
+        self.assertEqual(counts, {'updated': 9, 'cancelled': 0, 'moons': 9})
+        self.assertEqual(len(batch), len(single))
+        self.assertEqual(Extraction.objects.filter(active=True, total_volume=500).count(), 10)
+
+    @mock.patch('moonstuff.tasks._apply_moon_notifications')
+    @mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_check_corp_notifications_dedupes(self, esi, valid_access_token, apply_moon_notifications):
+        """
+        Tests that a notification received by several characters in a corporation is only stored and applied once.
+        :return:
+        """
+        char2 = EveCharacter.objects.create(character_name="The Second Char", character_id=2,
+                                            corporation_name="The First Corp", corporation_id=123,
+                                            corporation_ticker="ABC")
+        TrackingCharacter.objects.create(character=char2)
+        token2 = Token.objects.create(access_token='access', refresh_token='refresh', user=self.user1, character_id=2,
+                                      character_name='The Second Char', token_type='Character',
+                                      character_owner_hash='fghij')
+        now = datetime(2021, 6, 1, 12, tzinfo=pytz.utc)
+        text = 'moonID: 2\nstructureID: 1001\n'
+        operation = esi.client.Character.get_characters_character_id_notifications.return_value
+        operation.results.side_effect = [
+            esi_response([{'notification_id': 10, 'type': 'MoonminingExtractionCancelled', 'timestamp': now,
+                           'text': text}]),
+            esi_response([{'notification_id': 20, 'type': 'MoonminingExtractionCancelled', 'timestamp': now,
+                           'text': text}]),
+        ]
+        apply_moon_notifications.return_value = {'updated': 0, 'cancelled': 0, 'moons': 0}
+
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token, token2]}):
+            check_corp_notifications(123)
+
+        self.assertEqual(list(MoonNotification.objects.values_list('notification_id', flat=True)), [10])
+        apply_moon_notifications.assert_called_once()
+        self.assertEqual([n.notification_id for n in apply_moon_notifications.call_args[0][0]], [10])
+        self.assertEqual(
+            set(TrackingCharacter.objects.values_list('latest_notification_id', flat=True)), {10, 20}
+        )
+
+    @mock.patch('moonstuff.tasks._resolve_moons', return_value=set())
+    @mock.patch('moonstuff.tasks._get_structure_info')
+    def test_apply_moon_notifications_new_refineries(self, get_structure_info, resolve_moons):
+        """
+        Tests that new refineries are looked up with each token in turn, and skipped when no token can see them.
+        :return:
+        """
+        self._create_observer(999)
+        for moon_id in (1001, 1002):
+            EveMoon.objects.create(id=moon_id, eve_planet_id=1)
+        EveCharacter.objects.create(character_name="The Second Char", character_id=2,
+                                    corporation_name="The First Corp", corporation_id=123, corporation_ticker="ABC")
+        token2 = Token.objects.create(access_token='access', refresh_token='refresh', user=self.user1, character_id=2,
+                                      character_name='The Second Char', token_type='Character',
+                                      character_owner_hash='fghij')
+        forbidden = HTTPForbidden(mock.Mock(status_code=403, headers=dict(), reason='', text=''))
+
+        def structure_info(structure_id, token):
+            if structure_id == 1001 and token == token2:
+                return {'name': 'Test Refinery', 'owner_id': 123, 'type_id': 1}
+            raise forbidden
+        get_structure_info.side_effect = structure_info
+
+        now = datetime(2021, 6, 1, 12, tzinfo=pytz.utc)
+        _store_notifications(self.tracking1, [
+            {'notification_id': structure_id, 'type': 'MoonminingLaserFired', 'timestamp': now,
+             'text': f'moonID: {structure_id}\noreVolumeByType:\n  45490: 500.0\nstructureID: {structure_id}\n'
+                     f'structureName: Test Refinery\nstructureTypeID: 1\n'}
+            for structure_id in (1001, 1002)
+        ])
+
+        counts = _apply_moon_notifications(
+            list(MoonNotification.objects.order_by('notification_id')), [self.token, token2]
+        )
+        self.assertEqual(counts['moons'], 2)
+        self.assertEqual(set(Refinery.objects.values_list('structure_id', flat=True)), {999, 1001})
+        self.assertEqual(
+            [call[0] for call in get_structure_info.call_args_list],
+            [(1001, self.token), (1001, token2), (1002, self.token), (1002, token2)]
+        )
+        self.assertFalse(MoonNotification.objects.filter(processed__isnull=True).exists())
+
+    @mock.patch('moonstuff.tasks._apply_moon_notifications')
+    def test_process_notifications_in_order(self, apply_moon_notifications):
+        """
+        Tests that stored notifications received by different characters in a corporation are applied in order.
+        :return:
+        """
+        char2 = EveCharacter.objects.create(character_name="The Second Char", character_id=2,
+                                            corporation_name="The First Corp", corporation_id=123,
+                                            corporation_ticker="ABC")
+        tracking2 = TrackingCharacter.objects.create(character=char2)
+        apply_moon_notifications.return_value = {'updated': 0, 'cancelled': 0, 'moons': 0}
+        now = datetime(2021, 6, 1, 12, tzinfo=pytz.utc)
+        _store_notifications(self.tracking1, [
+            {'notification_id': 1, 'type': 'MoonminingExtractionCancelled', 'timestamp': now,
+             'text': 'moonID: 2\nstructureID: 1001\n'},
+        ])
+        _store_notifications(tracking2, [
+            {'notification_id': 2, 'type': 'MoonminingExtractionCancelled', 'timestamp': now - timedelta(days=1),
+             'text': 'moonID: 3\nstructureID: 1002\n'},
+        ])
+
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            process_notifications()
+
+        apply_moon_notifications.assert_called_once()
+        self.assertEqual([n.notification_id for n in apply_moon_notifications.call_args[0][0]], [2, 1])
+        self.assertEqual(apply_moon_notifications.call_args[0][1], [self.token])
+
+    def test_decode_notification(self):
+        """
+        Tests that notification texts decode the same as with safe_load.
+        :return:
+        """
+        for text in corpus.values():
+            self.assertEqual(_decode_notification(text), yaml.safe_load(text))
+        self.assertEqual(_decode_notification(corpus['MoonminingExtractionStarted'])['oreVolumeByType'][45490],
+                         2351428.3218946)
+
+    @skipUnless(os.environ.get('MOONSTUFF_BENCHMARK'), "Set MOONSTUFF_BENCHMARK=1 to run benchmarks.")
+    def test_decode_notification_benchmark(self):
+        """
+        Micro-benchmark of decoding the notification corpus with the loader in use, against the pure Python loader.
+        :return:
+        """
+        if not hasattr(yaml, 'CSafeLoader'):
+            self.skipTest("PyYAML was built without libyaml.")
+
+        texts = list(corpus.values()) * 20
+
+        def decode(loader):
+            return lambda: [yaml.load(text, Loader=loader) for text in texts]
+
+        fast = min(timeit.repeat(decode(yaml.CSafeLoader), number=1, repeat=3))
+        slow = min(timeit.repeat(decode(yaml.SafeLoader), number=1, repeat=3))
+        self.assertLess(fast, slow, f"CSafeLoader: {fast * 1000:.1f}ms, SafeLoader: {slow * 1000:.1f}ms "
+                                    f"for {len(texts)} notifications")
+
+    @mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_update_names(self, esi, valid_access_token):
+        """
+        Tests that only changed names are written, and that STALE is only appended once.
+        :return:
+        """
+        self._create_observer(1000)
+        self._create_observer(1001)
+        other_corp = EveCorporationInfo.objects.create(corporation_id=456, corporation_name="The Second Corp",
+                                                       corporation_ticker="DEF", member_count=1)
+        Refinery.objects.create(structure_id=2000, evetype_id=1, name="Other Refinery", corp=other_corp)
+        operation = esi.client.Universe.get_universe_structures_structure_id.return_value
+        operation.results.side_effect = [
+            esi_response({'name': 'Test Refinery', 'owner_id': 123, 'type_id': 1}),
+            esi_response({'name': 'Renamed Refinery', 'owner_id': 123, 'type_id': 1}),
+        ]
+
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            self.assertEqual(update_names(), 2)
+            # Names now come from the cache, and nothing has changed.
+            with self.assertNumQueries(3):
+                self.assertEqual(update_names(), 0)
+
+        self.assertEqual(
+            dict(Refinery.objects.values_list('structure_id', 'name')),
+            {1000: 'Test Refinery', 1001: 'Renamed Refinery', 2000: 'Other Refinery [STALE]'}
+        )
+
+    @mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_update_observers(self, esi, valid_access_token):
+        """
+        Tests that observer flags are compared with ESI, and only changes written.
+        :return:
+        """
+        self._create_observer(1000)
+        self._create_observer(1001)
+        Refinery.objects.filter(structure_id=1001).update(observer=False)
+        operation = esi.client.Industry.get_corporation_corporation_id_mining_observers.return_value
+        operation.result.return_value = esi_response([{'observer_id': 1001}])
+
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            self.assertEqual(update_observers(), 2)
+            self.assertEqual(update_observers(), 0)
+        self.assertEqual(dict(Refinery.objects.values_list('structure_id', 'observer')), {1000: False, 1001: True})
+
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={}):
+            self.assertEqual(update_observers(), 1)
+        self.assertFalse(Refinery.objects.filter(observer=True).exists())
+
+        # Observers are restored, and new refineries checked, even when the list from ESI has not changed.
+        self._create_observer(1002)
+        operation.result.side_effect = HTTPNotModified(mock.Mock(headers={'ETag': 'abc'}, status_code=304))
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}), \
+                mock.patch('moonstuff.tasks.cache.get', return_value={1: ('abc', [{'observer_id': 1001}])}):
+            self.assertEqual(update_observers(), 2)
+        self.assertEqual(
+            dict(Refinery.objects.values_list('structure_id', 'observer')), {1000: False, 1001: True, 1002: False}
+        )
+
+    @mock.patch('moonstuff.tasks.Token.valid_access_token', return_value='access')
+    @mock.patch('moonstuff.tasks.esi')
+    def test_structure_forbidden_does_not_block_token(self, esi, valid_access_token):
+        """
+        Tests that a 403 for a structure the character can not see does not put its token on a cooldown.
+        :return:
+        """
+        self._create_observer(1000)
+        self._create_observer(1001)
+        structures = esi.client.Universe.get_universe_structures_structure_id.return_value
+        structures.results.side_effect = [
+            HTTPForbidden(mock.Mock(status_code=403, headers=dict(), reason='', text='')),
+            esi_response({'name': 'Renamed Refinery', 'owner_id': 123, 'type_id': 1}),
+        ]
+        observers = esi.client.Industry.get_corporation_corporation_id_mining_observers.return_value
+        observers.result.return_value = esi_response([{'observer_id': 1000}])
+
+        with mock.patch('moonstuff.tasks._get_token_index', return_value={123: [self.token]}):
+            self.assertEqual(update_names(), 1)
+            self.assertEqual(update_observers(), 1)
+        self.assertEqual(structures.results.call_count, 2)
+        self.assertEqual(
+            dict(Refinery.objects.values_list('structure_id', 'observer')), {1000: True, 1001: False}
+        )
+
+    def test_bad_notification_does_not_block_others(self):
+        """
+        Tests that a notification that can not be applied is marked as failed, and the rest are still applied.
+        :return:
+        """
+        now = datetime(2021, 6, 1, 12, tzinfo=pytz.utc)
+        cancelled = Extraction.objects.create(
+            start_time=now - timedelta(days=2), arrival_time=now + timedelta(days=5),
+            decay_time=now + timedelta(days=5, hours=3), moon_id=40217116, refinery=self._create_observer(1001),
+            corp_id=1,
+        )
+        _store_notifications(self.tracking1, [
+            # Missing readyTime
+            {'notification_id': 1, 'type': 'MoonminingExtractionStarted', 'timestamp': now - timedelta(hours=1),
+             'text': 'moonID: 40217116\noreVolumeByType:\n  45490: 500.0\nstructureID: 1001\n'},
+            {'notification_id': 2, 'type': 'MoonminingExtractionCancelled', 'timestamp': now,
+             'text': 'moonID: 40217116\nstructureID: 1001\n'},
+        ])
+
+        counts = process_notifications()
+        self.assertEqual((counts['cancelled'], counts['failed']), (1, 1))
+        # Nothing is left to process, so later runs are not held up.
+        self.assertEqual(process_notifications()['failed'], 0)
+
+        cancelled.refresh_from_db()
+        self.assertTrue(cancelled.cancelled)
+        self.assertEqual(
+            dict(MoonNotification.objects.values_list('notification_id', 'error')),
+            {1: "KeyError: 'readyTime'", 2: None}
+        )
+        self.assertFalse(MoonNotification.objects.filter(processed__isnull=True).exists())